@@ -0,0 +1,94 @@
+import asyncio
+import time
+from collections import OrderedDict
+from aiohttp import web
+import config
+import metrics
+
+def client_ip(request):
+    # If behind ngrok (or another proxy), the real IP is in X-Forwarded-For
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        return forwarded_for.split(',')[0].strip()
+    return request.remote
+
+
+class IPRateLimiter:
+    # In-memory token bucket per client IP: `rate` requests per second on
+    # average with bursts of up to `burst`. The least recently seen IPs are
+    # dropped past max_entries, so a spoofed-IP flood can't grow it unbounded.
+
+    def __init__(self, rate, burst, max_entries=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()  # ip -> [tokens, last refill time]
+
+    def allow(self, ip):
+        # Returns 0 when allowed, otherwise seconds until the next token
+        now = time.monotonic()
+        bucket = self._buckets.get(ip)
+        if bucket is None:
+            bucket = self._buckets[ip] = [self.burst, now]
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(ip)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+
+class CallbackAdmission:
+    # aiohttp middleware for the OAuth callback: per-IP throttling, then a
+    # cap on callbacks in flight. Requests over the cap wait up to
+    # queue_timeout for a slot (at most max_queue of them) and are shed
+    # with 503 after that, so a flood can't use up outbound connections or
+    # the Discord rate-limit budget that the rest of the bot depends on.
+
+    def __init__(self, paths=("/callback",), max_concurrent=None, max_queue=None,
+                 queue_timeout=None, rate=None, burst=None):
+        self.paths = frozenset(paths)
+        self.max_concurrent = max_concurrent or config.CALLBACK_MAX_CONCURRENT
+        self.max_queue = config.CALLBACK_MAX_QUEUE if max_queue is None else max_queue
+        self.queue_timeout = queue_timeout or config.CALLBACK_QUEUE_TIMEOUT
+        self.limiter = IPRateLimiter(rate or config.CALLBACK_RATE_PER_IP, burst or config.CALLBACK_BURST_PER_IP)
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._waiting = 0
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path not in self.paths:
+            return await handler(request)
+
+        retry_after = self.limiter.allow(client_ip(request))
+        if retry_after:
+            metrics.CALLBACK_REQUESTS.inc(outcome="throttled")
+            return web.Response(status=429, text="Error: Too many requests. Please wait and try again.",
+                                headers={"Retry-After": str(max(1, round(retry_after)))})
+
+        if self._slots.locked():
+            if self._waiting >= self.max_queue:
+                return self._shed()
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                return self._shed()
+            finally:
+                self._waiting -= 1
+        else:
+            await self._slots.acquire()
+
+        try:
+            return await handler(request)
+        finally:
+            self._slots.release()
+
+    def _shed(self):
+        metrics.CALLBACK_REQUESTS.inc(outcome="shed")
+        return web.Response(status=503, text="Error: The server is busy. Please try again in a moment.",
+                            headers={"Retry-After": "5"})
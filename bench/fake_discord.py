@@ -0,0 +1,126 @@
+import asyncio
+import itertools
+import time
+from aiohttp import web
+
+# Local stand-in for the parts of the Discord REST API the bot calls:
+#   POST /oauth2/token                     (authorization_code and refresh_token grants)
+#   GET  /users/@me
+#   PUT  /guilds/{guild_id}/members/{user_id}
+# Tokens encode the user ID ("code-<id>", "access-<id>-<n>", "refresh-<id>-<n>")
+# so no state needs to be shared with the benchmark.
+
+class FakeBucket:
+    # Fixed-window rate limit that answers with Discord-style headers
+
+    def __init__(self, name, limit, window):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self._window_start = 0.0
+        self._used = 0
+
+    def hit(self):
+        # Returns (allowed, headers)
+        now = time.monotonic()
+        if now - self._window_start >= self.window:
+            self._window_start = now
+            self._used = 0
+        reset_after = max(self.window - (now - self._window_start), 0.0)
+        headers = {
+            "X-RateLimit-Bucket": self.name,
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+        }
+        if self._used >= self.limit:
+            headers["X-RateLimit-Remaining"] = "0"
+            headers["Retry-After"] = f"{reset_after:.3f}"
+            return False, headers
+        self._used += 1
+        headers["X-RateLimit-Remaining"] = str(self.limit - self._used)
+        return True, headers
+
+
+class FakeDiscord:
+    def __init__(self, latency=0.0, join_limit=None, join_window=1.0, token_limit=None, token_window=1.0):
+        # latency: seconds added to every response. *_limit: requests allowed per
+        # window on that route before answering 429 (None = unlimited).
+        self.latency = latency
+        self.join_bucket = FakeBucket("join", join_limit, join_window) if join_limit else None
+        self.token_bucket = FakeBucket("token", token_limit, token_window) if token_limit else None
+        self.requests = 0
+        self.rate_limited = 0
+        self._serial = itertools.count(1)
+        self._members = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/oauth2/token", self.token)
+        app.router.add_get("/users/@me", self.me)
+        app.router.add_put("/guilds/{guild_id}/members/{user_id}", self.add_member)
+        return app
+
+    async def _respond(self, bucket):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if bucket is None:
+            return None, {}
+        allowed, headers = bucket.hit()
+        if not allowed:
+            self.rate_limited += 1
+            retry_after = float(headers["Retry-After"])
+            return web.json_response(
+                {"message": "You are being rate limited.", "retry_after": retry_after, "global": False},
+                status=429, headers=headers
+            ), headers
+        return None, headers
+
+    def _tokens(self, user_id):
+        n = next(self._serial)
+        return {
+            "access_token": f"access-{user_id}-{n}",
+            "refresh_token": f"refresh-{user_id}-{n}",
+            "expires_in": 604800,
+            "token_type": "Bearer",
+            "scope": "identify guilds.join",
+        }
+
+    async def token(self, request):
+        limited, headers = await self._respond(self.token_bucket)
+        if limited:
+            return limited
+        form = await request.post()
+        if form.get("grant_type") == "authorization_code":
+            user_id = form.get("code", "").removeprefix("code-")
+        else:
+            user_id = form.get("refresh_token", "").split("-")[1]
+        return web.json_response(self._tokens(user_id), headers=headers)
+
+    async def me(self, request):
+        await self._respond(None)
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        user_id = token.split("-")[1]
+        return web.json_response({"id": user_id, "username": f"user{user_id}", "avatar": None})
+
+    async def add_member(self, request):
+        limited, headers = await self._respond(self.join_bucket)
+        if limited:
+            return limited
+        key = (request.match_info["guild_id"], request.match_info["user_id"])
+        if key in self._members:
+            return web.Response(status=204, headers=headers)
+        self._members.add(key)
+        return web.json_response({}, status=201, headers=headers)
+
+    async def start(self, host="127.0.0.1", port=0):
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        self._runner = runner
+        sockets = site._server.sockets
+        return f"http://{host}:{sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        await self._runner.cleanup()
@@ -0,0 +1,226 @@
+"""Offline throughput benchmarks against a fake Discord API and a local SQLite file.
+
+Usage (from the repository root):
+    python -m bench.run                              # 1k and 10k users, every scenario
+    python -m bench.run --users 1000 10000 100000
+    python -m bench.run --scenarios join --latency 0.05 --join-limit 10
+
+Scenarios:
+    callback  OAuth /callback requests through the real aiohttp app, ack latency
+              plus time until the background grant pipeline has drained
+    join      AuthCog._perform_join_logic over every stored user via the bulk engine
+    refresh   one token_refresh_task cycle with every token due
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--scenarios", nargs="+", default=["callback", "join", "refresh"],
+                        choices=["callback", "join", "refresh"])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake API response")
+    parser.add_argument("--join-limit", type=int, default=None, help="add-member requests per window before 429")
+    parser.add_argument("--token-limit", type=int, default=None, help="/oauth2/token requests per window before 429")
+    parser.add_argument("--window", type=float, default=1.0, help="rate-limit window in seconds")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent /callback clients")
+    return parser.parse_args(argv)
+
+
+def summarize(name, users, latencies, elapsed):
+    if len(latencies) >= 2:
+        q = statistics.quantiles(latencies, n=100)
+        p50, p95, p99 = q[49], q[94], q[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else 0.0
+    rps = len(latencies) / elapsed if elapsed else 0.0
+    print(f"{name:<18} {users:>7} {rps:>10.1f} {p50 * 1000:>9.2f} {p95 * 1000:>9.2f} {p99 * 1000:>9.2f} {elapsed:>9.2f}")
+
+
+class BenchMember:
+    def __init__(self, guild, user_id):
+        self.guild = guild
+        self.id = user_id
+
+    def get_role(self, role_id):
+        return None
+
+    async def add_roles(self, *roles):
+        pass
+
+
+class BenchRole:
+    def __init__(self, role_id):
+        self.id = role_id
+
+
+class BenchGuild:
+    # Every user is a member, so the grant pipeline always reaches add_roles
+
+    def __init__(self, guild_id, role_id):
+        self.id = guild_id
+        self.role = BenchRole(role_id)
+        self.role_id = role_id
+
+    def get_role(self, role_id):
+        return self.role if role_id == self.role_id else None
+
+    def get_member(self, user_id):
+        return BenchMember(self, user_id)
+
+
+async def seed_users(storage, count, expires_at):
+    await storage.save_users(
+        (uid, {
+            "username": f"user{uid}",
+            "access_token": f"access-{uid}-0",
+            "refresh_token": f"refresh-{uid}-0",
+            "expires_at": expires_at,
+        }) for uid in range(1, count + 1)
+    )
+
+
+async def bench_callback(users, args, bot):
+    import server
+    from aiohttp import ClientSession, TCPConnector, web
+    from oauth_state import make_state
+
+    guild = bot.bench_guild
+    state = make_state(guild.role_id, guild.id)
+    runner = web.AppRunner(server.setup_server(bot))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    latencies = []
+    queue = asyncio.Queue()
+    for uid in range(1, users + 1):
+        queue.put_nowait(uid)
+
+    async def client(session):
+        while not queue.empty():
+            uid = queue.get_nowait()
+            start = time.perf_counter()
+            # One client IP per user, as in production, so per-IP throttling doesn't kick in
+            headers = {"X-Forwarded-For": f"10.{uid >> 16 & 255}.{uid >> 8 & 255}.{uid & 255}"}
+            async with session.get(f"{base}/callback", params={"code": f"code-{uid}", "state": state},
+                                   headers=headers) as resp:
+                await resp.read()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    async with ClientSession(connector=TCPConnector(limit=args.concurrency)) as session:
+        await asyncio.gather(*(client(session) for _ in range(args.concurrency)))
+    ack_elapsed = time.perf_counter() - start
+    await bot.grant_pipeline._queue.join()
+    total_elapsed = time.perf_counter() - start
+    await runner.cleanup()
+
+    summarize("callback (ack)", users, latencies, ack_elapsed)
+    print(f"{'callback (e2e)':<18} {users:>7} {users / total_elapsed:>10.1f} {'':>9} {'':>9} {'':>9} {total_elapsed:>9.2f}")
+
+
+async def bench_join(users, args, bot, storage):
+    from cogs.auth import AuthCog
+    from join_engine import BulkJoinEngine
+
+    cog = AuthCog(bot)
+    latencies = []
+
+    async def join_one(uid, user_data):
+        start = time.perf_counter()
+        res = await cog._perform_join_logic(bot.bench_guild.id, uid, user_data)
+        latencies.append(time.perf_counter() - start)
+        return res
+
+    engine = BulkJoinEngine(join_one)
+    start = time.perf_counter()
+    counts = await engine.run(storage.iter_users(), total=users)
+    elapsed = time.perf_counter() - start
+    summarize("join", users, latencies, elapsed)
+    if counts["failed"]:
+        print(f"  join failures: {counts['failed']}")
+
+
+async def bench_refresh(users, args, bot, storage):
+    # Every token is already inside the refresh margin
+    await seed_users(storage, users, time.time() + 60)
+    await bot.refresh_scheduler.load()
+
+    latencies = []
+    refresh = bot.refresh_user_token
+
+    async def timed_refresh(user_id, refresh_token):
+        start = time.perf_counter()
+        try:
+            return await refresh(user_id, refresh_token)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    bot.refresh_user_token = timed_refresh
+    start = time.perf_counter()
+    await bot.token_refresh_task()
+    elapsed = time.perf_counter() - start
+    bot.refresh_user_token = refresh
+    summarize("refresh", users, latencies, elapsed)
+
+
+async def run_size(users, args, db_path):
+    import discord_api
+    import storage
+    from bot import AuthBot
+
+    bot = AuthBot()
+    bot.bench_guild = BenchGuild(1, 2)
+    bot.get_guild = lambda guild_id: bot.bench_guild if guild_id == bot.bench_guild.id else None
+    bot.wait_until_ready = lambda: asyncio.sleep(0)  # Never logs in; the fake guild is always "ready"
+    bot.grant_pipeline.start()
+
+    try:
+        if "callback" in args.scenarios:
+            await bench_callback(users, args, bot)
+        if "join" in args.scenarios:
+            await seed_users(storage, users, time.time() + 604800)
+            await bench_join(users, args, bot, storage)
+        if "refresh" in args.scenarios:
+            await bench_refresh(users, args, bot, storage)
+    finally:
+        await bot.grant_pipeline.stop()
+        await discord_api.close()
+        await storage.close_storage()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+
+async def main(args):
+    from bench.fake_discord import FakeDiscord
+
+    fake = FakeDiscord(latency=args.latency, join_limit=args.join_limit,
+                       token_limit=args.token_limit, join_window=args.window, token_window=args.window)
+    os.environ["DISCORD_API_BASE"] = await fake.start()
+
+    print(f"{'scenario':<18} {'users':>7} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'total s':>9}")
+    try:
+        for users in args.users:
+            await run_size(users, args, os.environ["SQLITE_PATH"])
+    finally:
+        await fake.stop()
+    print(f"fake API: {fake.requests} requests, {fake.rate_limited} rate limited")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # config reads the environment at import time, so set it before any project import
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="verify-bot-bench-"), "bench.db")
+    os.environ.setdefault("CLIENT_SECRET", "bench")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    asyncio.run(main(args))
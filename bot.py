@@ -1,122 +1,323 @@
 import discord
+import logging
 from discord.ext import commands, tasks
 import config
 import server
 from aiohttp import web
 import asyncio
 import time
-import aiohttp
+import discord_api
 from pyngrok import ngrok
 import sys
 import os # Added for env vars
 import storage  # New storage module
+from refresh_scheduler import TokenRefreshScheduler
+from role_index import RoleIndex
+from member_index import MemberIndex
+from grant_pipeline import GrantPipeline
+from role_grants import RoleGrantQueue
+from grant_relay import RoleGrantRelay
+import metrics
+from command_sync import sync_if_changed
+from log_setup import SAMPLED, setup_logging
+from models import UserRecord
+from loop_monitor import LoopLagMonitor
+
+log = logging.getLogger(__name__)
 
 class AuthBot(commands.Bot):
     def __init__(self):
         intents = discord.Intents.default()
         intents.members = True
         intents.message_content = True
-        super().__init__(command_prefix="!", intents=intents)
+        options = {}
+        if config.MEMBER_CACHE == "lean":
+            # Keep only member IDs (self.member_index), fetch full members on demand
+            options = {"member_cache_flags": discord.MemberCacheFlags.none(), "chunk_guilds_at_startup": False}
+        super().__init__(command_prefix="!", intents=intents, **options)
+        self.member_index = MemberIndex() if config.MEMBER_CACHE == "lean" else None
+        self._chunk_task = None
+        self._refreshes = {}  # user_id -> in-flight refresh task
+        self.loop_monitor = LoopLagMonitor()
+        self.refresh_scheduler = TokenRefreshScheduler()
+        self.role_index = RoleIndex()
+        self.grant_pipeline = GrantPipeline(self)
+        self.role_grants = RoleGrantQueue()
+        self.grant_relay = RoleGrantRelay(self)
 
     async def setup_hook(self):
-        await storage.init_storage()  # Init JSON storage
-        await self.load_extension("cogs.auth")
-        
-        # Sync Slash Commands is now moved to manual command to avoid rate limits on Render
-        print("Bot is ready. Use /sync (admin only) if you need to update commands.")
-        
-        # Start Web Server
+        # Bind the port first so the host's health check passes on a cold start;
+        # callbacks that arrive before storage is ready wait in init_storage().
+        timings = []
+        started = time.perf_counter()
+        self.loop_monitor.start()  # Logs the stack if anything below blocks the loop
+
+        async def timed(phase, coro):
+            phase_start = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                timings.append((phase, time.perf_counter() - phase_start))
+
+        port = int(os.getenv("PORT", 8080))
+        if config.RUN_MODE != "gateway":
+            await timed("web_server", self.start_web_server(port))
+        else:
+            await timed("metrics_server", self.start_metrics_server(config.METRICS_PORT))
+
+        # Independent phases run together. The tunnel blocks, so it runs on a thread.
+        phases = [timed("storage", self._init_storage()), timed("extensions", self.load_extension("cogs.auth"))]
+        if config.RUN_MODE != "gateway":
+            phases.append(timed("tunnel", self.start_tunnel(port)))
+        await asyncio.gather(*phases)
+
+        if config.SYNC_COMMANDS_ON_START:
+            # Only uploads when the command tree changed since the last sync
+            await timed("command_sync", self._sync_commands())
+        else:
+            log.info("Bot is ready. Use /sync (admin only) if you need to update commands.")
+
+        if config.RUN_MODE == "gateway":
+            # Web workers run separately and queue role grants in storage
+            await timed("grant_relay", self.grant_relay.start())
+
+        await timed("refresh_schedule", self.refresh_scheduler.load())
+        self.token_refresh_task.start()
+
+        breakdown = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings)
+        log.info("Startup finished in %.2fs (%s)", time.perf_counter() - started, breakdown)
+
+    async def _sync_commands(self):
+        try:
+            synced = await sync_if_changed(self.tree)
+        except Exception as e:
+            log.error("Command sync failed: %s", e)
+            return
+        if synced is None:
+            log.info("Slash commands unchanged, skipped sync")
+        else:
+            log.info("Synced %d slash commands", synced)
+
+    async def _init_storage(self):
+        await storage.init_storage()
+        if config.STORAGE_WRITE_BEHIND:
+            await storage.start_write_behind()
+
+    async def start_web_server(self, port):
+        # Start Web Server (the OAuth callback hands its slow work to the grant pipeline)
+        self.grant_pipeline.start()
         app = server.setup_server(self)
         runner = web.AppRunner(app)
         await runner.setup()
-        # Determine Port (Render provides PORT environment variable)
-        port = int(os.getenv("PORT", 8080))
         site = web.TCPSite(runner, '0.0.0.0', port)
         await site.start()
-        print(f"Web server started on port {port}")
+        log.info("Web server started on port %d", port)
 
-        # Start ngrok
+    async def start_metrics_server(self, port):
+        # Gateway mode has no OAuth app, but its loop is the one worth watching
+        runner = web.AppRunner(server.setup_diagnostics_server())
+        await runner.setup()
+        site = web.TCPSite(runner, '0.0.0.0', port)
+        await site.start()
+        log.info("Metrics server started on port %d", port)
+
+    async def start_tunnel(self, port):
+        # pyngrok downloads/starts the ngrok binary and waits on it synchronously
         try:
-            # Set auth token if provided
-            if config.NGROK_AUTH_TOKEN:
-                ngrok.set_auth_token(config.NGROK_AUTH_TOKEN)
-            
-            # Open a HTTP tunnel on the specified port
-            if config.NGROK_DOMAIN:
-                public_url = ngrok.connect(port, domain=config.NGROK_DOMAIN).public_url
-                print(f"Using Static Domain: {public_url}")
-            else:
-                public_url = ngrok.connect(port).public_url
-                print(f"Using Random Domain: {public_url}")
-
-            print("\n" + "="*50)
-            print(f"ngrok Tunnel Started: {public_url}")
-            
-            # Update config with the new URL
-            config.REDIRECT_URI = public_url + "/callback"
-            print(f"Updated Redirect URI: {config.REDIRECT_URI}")
-            
-            print("IMPORTANT: You must copy the above 'Updated Redirect URI' to your Discord Developer Portal > OAuth2 > Redirects!")
-            print("="*50 + "\n")
-            
+            public_url = await asyncio.to_thread(self._open_tunnel, port)
         except Exception as e:
-            print(f"Failed to start ngrok: {e}")
-            print("Please ensure ngrok is installed and authenticated if you want external access.")
+            log.warning("Failed to start ngrok: %s", e)
+            log.warning("Please ensure ngrok is installed and authenticated if you want external access.")
+            return
 
-        self.token_refresh_task.start()
+        log.info("ngrok Tunnel Started: %s", public_url)
+
+        # Update config with the new URL
+        config.REDIRECT_URI = public_url + "/callback"
+        log.info("Updated Redirect URI: %s", config.REDIRECT_URI)
+        log.warning("IMPORTANT: You must copy the above 'Updated Redirect URI' to your Discord Developer Portal > OAuth2 > Redirects!")
+
+    def _open_tunnel(self, port):
+        # Set auth token if provided
+        if config.NGROK_AUTH_TOKEN:
+            ngrok.set_auth_token(config.NGROK_AUTH_TOKEN)
+
+        # Open a HTTP tunnel on the specified port
+        if config.NGROK_DOMAIN:
+            public_url = ngrok.connect(port, domain=config.NGROK_DOMAIN).public_url
+            log.info("Using Static Domain: %s", public_url)
+        else:
+            public_url = ngrok.connect(port).public_url
+            log.info("Using Random Domain: %s", public_url)
+        return public_url
 
     async def on_ready(self):
-        print(f'Logged in as {self.user} (ID: {self.user.id})')
-        print('------')
+        self.role_index.rebuild(self.guilds)
+        log.info("Logged in as %s (ID: %s)", self.user, self.user.id)
+        log.info("Indexed %d roles across %d guilds", len(self.role_index), len(self.guilds))
+        if self.member_index is not None and (self._chunk_task is None or self._chunk_task.done()):
+            self._chunk_task = asyncio.create_task(self._chunk_member_index())
+
+    # Keep the role -> guild index current for the OAuth callback
+    async def on_guild_join(self, guild):
+        self.role_index.add_guild(guild)
+        if self.member_index is not None:
+            await self._chunk_guild(guild)
+
+    async def on_guild_available(self, guild):
+        self.role_index.add_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.role_index.remove_guild(guild)
+        if self.member_index is not None:
+            self.member_index.remove_guild(guild.id)
+
+    async def on_guild_role_create(self, role):
+        self.role_index.add_role(role)
+
+    async def on_guild_role_delete(self, role):
+        self.role_index.remove_role(role)
+
+    # Lean member cache (MEMBER_CACHE=lean)
+    async def on_member_join(self, member):
+        if self.member_index is not None:
+            self.member_index.add(member.guild.id, member.id)
+
+    async def on_raw_member_remove(self, payload):
+        # member_remove isn't dispatched for uncached members, the raw event always is
+        if self.member_index is not None:
+            self.member_index.discard(payload.guild_id, payload.user.id)
+
+    async def _chunk_member_index(self):
+        # One guild at a time, so only one guild's chunk is held in memory
+        for guild in list(self.guilds):
+            if not self.member_index.is_loaded(guild.id):
+                await self._chunk_guild(guild)
+        log.info("Member index: %d members across %d guilds", len(self.member_index), len(self.guilds))
+
+    async def _chunk_guild(self, guild):
+        self.member_index.begin_load(guild.id)
+        try:
+            members = await guild.chunk(cache=False)
+        except Exception as e:
+            log.error("Failed to chunk guild %s: %s", guild.id, e)
+            self.member_index.remove_guild(guild.id)
+            return
+        self.member_index.finish_load(guild.id, [m.id for m in members])
+
+    def is_member(self, guild, user_id):
+        # True/False, or None while the lean index is still loading this guild
+        if self.member_index is None:
+            return guild.get_member(user_id) is not None
+        return self.member_index.contains(guild.id, user_id)
 
-    @tasks.loop(minutes=60)
+    async def resolve_member(self, guild, user_id):
+        # Full Member object, fetched over REST when the cache only holds IDs
+        if self.member_index is None:
+            return guild.get_member(user_id)
+        if self.member_index.contains(guild.id, user_id) is False:
+            return None
+        try:
+            return await guild.fetch_member(user_id)
+        except discord.NotFound:
+            self.member_index.discard(guild.id, user_id)
+            return None
+
+    @tasks.loop(minutes=1)
     async def token_refresh_task(self):
-        print("Checking for expiring tokens...")
-        users_map = await storage.get_all_users()
-        current_time = time.time()
-        
-        for user_id, user_data in users_map.items():
-            expires_at = user_data.get("expires_at", 0)
-            refresh = user_data.get("refresh_token")
-            
-            # Refresh if expiring in less than 6 hours
-            if expires_at - current_time < 21600: 
-                print(f"Refreshing token for user {user_id}")
-                await self.refresh_user_token(int(user_id), refresh)
+        due = self.refresh_scheduler.pop_due()
+        if not due:
+            return
+        log.info("Refreshing %d expiring tokens...", len(due))
+        semaphore = asyncio.Semaphore(config.REFRESH_CONCURRENCY)
+
+        async def refresh_one(user_id):
+            # pop_due() already dropped this user from the schedule, so any
+            # failure here (storage included) must reschedule, never escape
+            async with semaphore:
+                ok = None
+                try:
+                    # Re-read so we use the latest refresh token (it is single-use)
+                    user_data = await storage.get_user(user_id)
+                    if not user_data:
+                        return  # Removed since it was scheduled
+                    ok = await self.refresh_user_token(user_id, user_data.refresh_token)
+                except Exception as e:
+                    log.warning("Error refreshing token for %s: %s", user_id, e, extra=SAMPLED)
+                    metrics.TOKEN_REFRESHES.inc(outcome="error")
+                    await self._record_refresh_failure(user_id)
+                if not ok:
+                    self.refresh_scheduler.schedule_at(user_id, time.time() + config.REFRESH_RETRY_DELAY)
+
+        await asyncio.gather(*(refresh_one(user_id) for user_id in due), return_exceptions=True)
+
+    async def _record_refresh_failure(self, user_id):
+        # Best effort: the /stats counter must not turn a failed refresh into a crash
+        try:
+            await storage.record_refresh_failure(user_id)
+        except Exception as e:
+            log.warning("Could not record refresh failure for %s: %s", user_id, e, extra=SAMPLED)
 
     async def refresh_user_token(self, user_id, refresh_token):
-        data = {
-            'client_id': config.CLIENT_ID,
-            'client_secret': config.CLIENT_SECRET,
-            'grant_type': 'refresh_token',
-            'refresh_token': refresh_token
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post('https://discord.com/api/oauth2/token', data=data) as resp:
-                if resp.status == 200:
-                    token_data = await resp.json()
-                    
-                    # Update User Data
-                    user_str = str(user_id)
-                    current_data = await storage.get_user(user_id) or {}
-                    current_data.update({
-                        "access_token": token_data['access_token'],
-                        "refresh_token": token_data['refresh_token'],
-                        "expires_at": time.time() + token_data['expires_in']
-                    })
-                    await storage.save_user(user_id, current_data)
-                    
-                    print(f"Token refreshed for {user_id}")
-                    return token_data['access_token']
-                else:
-                    print(f"Failed to refresh token for {user_id}: {await resp.text()}")
-                    return None
+        # Refresh tokens are single-use, so concurrent callers for one user
+        # (refresh task, /join) share one in-flight refresh and its result.
+        task = self._refreshes.get(user_id)
+        if task is not None:
+            metrics.TOKEN_REFRESHES.inc(outcome="coalesced")
+            return await asyncio.shield(task)
+        task = asyncio.create_task(self._refresh_user_token(user_id, refresh_token))
+        self._refreshes[user_id] = task
+        task.add_done_callback(lambda _: self._refreshes.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _refresh_user_token(self, user_id, refresh_token):
+        # A caller holding an older copy of the user may arrive just after a
+        # refresh finished; its refresh token is spent, use the stored result.
+        current = await storage.get_user(user_id)
+        if current and current.refresh_token != refresh_token and current.expires_at > time.time() + 60:
+            metrics.TOKEN_REFRESHES.inc(outcome="coalesced")
+            return current.access_token
+
+        resp = await discord_api.refresh_token(refresh_token)
+        if resp.status == 200:
+            token_data = resp.data
+            
+            # Update User Data
+            user = current or UserRecord(user_id)
+            user.access_token = token_data['access_token']
+            user.refresh_token = token_data['refresh_token']
+            user.expires_at = time.time() + token_data['expires_in']
+            await storage.save_user(user_id, user)
+            self.refresh_scheduler.schedule(user_id, user.expires_at)
+            
+            metrics.TOKEN_REFRESHES.inc(outcome="success")
+            log.info("Token refreshed for %s", user_id, extra=SAMPLED)
+            return token_data['access_token']
+        else:
+            metrics.TOKEN_REFRESHES.inc(outcome="failed")
+            log.warning("Failed to refresh token for %s: %s", user_id, resp.data, extra=SAMPLED)
+            await self._record_refresh_failure(user_id)
+            return None
+
+    async def close(self):
+        await self.loop_monitor.stop()
+        await self.grant_pipeline.stop()
+        await self.grant_relay.stop()
+        if self._chunk_task is not None:
+            self._chunk_task.cancel()
+        await self.role_grants.stop()
+        await super().close()  # Unloads the cogs, which checkpoints running join jobs
+        await discord_api.close()
+        await storage.close_storage()  # Flush buffered writes
 
 bot = AuthBot()
 
 if __name__ == "__main__":
+    setup_logging()
     if not config.BOT_TOKEN:
-        print("Error: BOT_TOKEN is not set in .env")
+        log.error("BOT_TOKEN is not set in .env")
+    elif config.RUN_MODE == "web":
+        log.error("RUN_MODE=web is served by web_worker.py, run the gateway with RUN_MODE=gateway")
     else:
-        bot.run(config.BOT_TOKEN)
+        # discord.py logs through our queue handler instead of installing its own
+        bot.run(config.BOT_TOKEN, log_handler=None)
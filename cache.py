@@ -0,0 +1,50 @@
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    # Small in-process LRU cache whose entries also expire after `ttl` seconds.
+    # Not thread-safe; it is only used from the event loop.
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        # Bumped by every invalidate()/clear(). A read-through fill captures it
+        # before its (slow) load and passes it to set(), which drops the value
+        # if a write invalidated the cache in the meantime.
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        self.generation += 1
+
+    def clear(self):
+        self._data.clear()
+        self.generation += 1
+
+_MISSING = object()
@@ -4,11 +4,39 @@ from discord import ui
 import storage
 import config
 import time
-import aiohttp
+import asyncio
+import discord_api
+import metrics
+from join_jobs import JoinJobManager, format_counts
+from oauth_state import make_state
+from models import UserRecord
+from command_sync import sync_if_changed
 
 # Quiz Answer
 QUIZ_ANSWER = "4"
 
+async def queue_role_grant(interaction: discord.Interaction, role: discord.Role, success_message: str, forbidden_message: str):
+    # Acknowledge right away and let the per-guild grant queue do the add_roles,
+    # so bursts of clicks never miss the 3-second interaction deadline
+    member = interaction.user
+    if member.get_role(role.id):
+        await interaction.response.send_message(f"既に {role.name} ロールが付与されています。", ephemeral=True)
+        return
+
+    future, queued = interaction.client.role_grants.submit(member, role)
+    if not queued:
+        await interaction.response.send_message("認証を処理中です。しばらくお待ちください。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        await future
+        await interaction.followup.send(success_message, ephemeral=True)
+    except discord.Forbidden:
+        await interaction.followup.send(forbidden_message, ephemeral=True)
+    except Exception as e:
+        await interaction.followup.send(f"エラー：ロールの付与に失敗しました。({e})", ephemeral=True)
+
 class QuizModal(ui.Modal, title='認証クイズ'):
     def __init__(self, role_id):
         super().__init__()
@@ -20,19 +48,115 @@ class QuizModal(ui.Modal, title='認証クイズ'):
         if self.answer.value.strip() == QUIZ_ANSWER:
             role = interaction.guild.get_role(self.role_id)
             if role:
-                try:
-                    await interaction.user.add_roles(role)
-                    await interaction.response.send_message(f"正解です！ロール {role.name} を付与しました。", ephemeral=True)
-                except discord.Forbidden:
-                    await interaction.response.send_message("エラー：権限不足でロールを付与できませんでした。", ephemeral=True)
+                await queue_role_grant(
+                    interaction, role,
+                    f"正解です！ロール {role.name} を付与しました。",
+                    "エラー：権限不足でロールを付与できませんでした。"
+                )
             else:
                 await interaction.response.send_message("エラー：ロールが見つかりません。", ephemeral=True)
         else:
             await interaction.response.send_message("不正解です。もう一度試してください。", ephemeral=True)
 
+class UserListView(ui.View):
+    # Paginated /list. Each page is one keyset query over the display columns,
+    # so paging costs the same at user 20 and user 100k.
+    PAGE_SIZE = 20
+
+    def __init__(self, owner_id, prefix=None):
+        super().__init__(timeout=300)
+        self.owner_id = owner_id
+        self.prefix = prefix
+        self.total = 0
+        self.page = 0
+        self.rows = []
+        self.has_prev = False
+        self.has_next = False
+
+    async def load(self):
+        self.total = await storage.count_users(self.prefix)
+        rows = await storage.list_users_page(prefix=self.prefix, limit=self.PAGE_SIZE + 1)
+        self._set_page(rows, has_prev=False, has_next=len(rows) > self.PAGE_SIZE)
+        return bool(self.rows)
+
+    def _set_page(self, rows, has_prev, has_next, from_end=False):
+        # Pages are fetched with one extra row to know whether more exist
+        if len(rows) > self.PAGE_SIZE:
+            rows = rows[1:] if from_end else rows[:self.PAGE_SIZE]
+        self.rows = rows
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_page.disabled = not has_prev
+        self.next_page.disabled = not has_next
+
+    def _cursor(self, row):
+        uid, username = row
+        return (username, uid)
+
+    def build_embed(self):
+        title = f"保存済みユーザー一覧 ({self.total}名)"
+        if self.prefix:
+            title += f" - 「{self.prefix}」で検索"
+        lines = [f"• <@{uid}> (`{uid}`) - {username}" for uid, username in self.rows]
+        embed = discord.Embed(title=title, description="\n".join(lines), color=discord.Color.gold())
+        pages = max(1, -(-self.total // self.PAGE_SIZE))
+        embed.set_footer(text=f"ページ {self.page + 1}/{pages}")
+        return embed
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("このボタンはコマンドを実行した管理者のみ使用できます。", ephemeral=True)
+            return False
+        return True
+
+    @ui.button(label="◀ 前へ", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord.Interaction, button: ui.Button):
+        rows = await storage.list_users_page(
+            cursor=self._cursor(self.rows[0]), backwards=True, prefix=self.prefix, limit=self.PAGE_SIZE + 1
+        )
+        if not rows:
+            # Users were removed since this page was shown, start over
+            self.page = 0
+            await self.load()
+        else:
+            self.page = max(0, self.page - 1)
+            self._set_page(rows, has_prev=len(rows) > self.PAGE_SIZE, has_next=True, from_end=True)
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+    @ui.button(label="次へ ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: ui.Button):
+        rows = await storage.list_users_page(
+            cursor=self._cursor(self.rows[-1]), prefix=self.prefix, limit=self.PAGE_SIZE + 1
+        )
+        if not rows:
+            # Users were removed since this page was shown
+            self._set_page(self.rows, has_prev=self.has_prev, has_next=False)
+        else:
+            self.page += 1
+            self._set_page(rows, has_prev=True, has_next=len(rows) > self.PAGE_SIZE)
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
 class AuthCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.join_jobs = JoinJobManager(self)
+        self._jobs_resumed = False
+
+    async def cog_load(self):
+        if self.bot.is_ready():
+            # Reloaded while connected, on_ready won't fire again
+            self._jobs_resumed = True
+            asyncio.create_task(self.join_jobs.resume_all())
+
+    async def cog_unload(self):
+        await self.join_jobs.stop()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready fires again after reconnects, only resume once
+        if not self._jobs_resumed:
+            self._jobs_resumed = True
+            await self.join_jobs.resume_all()
 
     # GLOBAL INTERACTION LISTENER for buttons
     @commands.Cog.listener()
@@ -54,11 +178,11 @@ class AuthCog(commands.Cog):
         if method_id == "1": # Simple Click
             role = interaction.guild.get_role(role_id)
             if role:
-                try:
-                    await interaction.user.add_roles(role)
-                    await interaction.response.send_message(f"認証完了！{role.name} ロールを付与しました。", ephemeral=True)
-                except discord.Forbidden:
-                    await interaction.response.send_message("エラー：権限不足でロールを付与できませんでした。Botのロール順序を確認してください。", ephemeral=True)
+                await queue_role_grant(
+                    interaction, role,
+                    f"認証完了！{role.name} ロールを付与しました。",
+                    "エラー：権限不足でロールを付与できませんでした。Botのロール順序を確認してください。"
+                )
             else:
                 await interaction.response.send_message("エラー：設定されたロールが見つかりません。", ephemeral=True)
 
@@ -97,7 +221,8 @@ class AuthCog(commands.Cog):
     @auth_group.command(name="oauth", description="アプリ連携認証のパネルを作成します")
     @discord.app_commands.describe(role="付与するロール")
     async def auth_oauth(self, interaction: discord.Interaction, role: discord.Role):
-        state = f"{role.id}"
+        # Signed so the callback can go straight to this guild
+        state = make_state(role.id, interaction.guild.id)
         url = f"https://discord.com/oauth2/authorize?client_id={config.CLIENT_ID}&response_type=code&redirect_uri={config.REDIRECT_URI}&scope=identify+guilds.join&state={state}"
         
         embed = discord.Embed(title="アプリ連携認証", description="以下のボタンを押して連携を許可してください。", color=discord.Color.purple())
@@ -118,15 +243,15 @@ class AuthCog(commands.Cog):
              await interaction.response.send_message(f"{user.mention} のデータは見つかりませんでした。", ephemeral=True)
              return
              
-        embed = discord.Embed(title=f"ユーザー詳細: {user_data.get('username')}", color=discord.Color.orange())
-        # Use avatar from JSON or fallback to current avatar
-        avatar_url = user_data.get('avatar_url') or (user.display_avatar.url if user.display_avatar else None)
+        embed = discord.Embed(title=f"ユーザー詳細: {user_data.username}", color=discord.Color.orange())
+        # Use stored avatar or fallback to current avatar
+        avatar_url = user_data.avatar_url or (user.display_avatar.url if user.display_avatar else None)
         if avatar_url:
             embed.set_thumbnail(url=avatar_url)
             
         embed.add_field(name="User ID", value=f"`{user.id}`", inline=True)
         
-        ip_addr = user_data.get('ip_address', 'Unknown')
+        ip_addr = user_data.ip_address or 'Unknown'
         ip_label = "IP Address"
         if ":" in ip_addr:
             ip_label += " (IPv6)"
@@ -136,32 +261,43 @@ class AuthCog(commands.Cog):
         embed.add_field(name=ip_label, value=f"`{ip_addr}`", inline=True)
         
         # Mask Token for security in display
-        token = user_data.get('access_token', '')
+        token = user_data.access_token or ''
         masked_token = f"||{token[:15]}...||" if token else "None"
         embed.add_field(name="Access Token", value=masked_token, inline=False)
-        embed.add_field(name="Expires At", value=f"<t:{int(user_data.get('expires_at', 0))}:R> (<t:{int(user_data.get('expires_at', 0))}:f>)", inline=True)
+        embed.add_field(name="Expires At", value=f"<t:{int(user_data.expires_at)}:R> (<t:{int(user_data.expires_at)}:f>)", inline=True)
         
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @discord.app_commands.command(name="list", description="保存されている全ユーザーを表示します")
-    async def list_users(self, interaction: discord.Interaction):
+    @discord.app_commands.describe(prefix="ユーザー名の前方一致で絞り込み（省略可）")
+    async def list_users(self, interaction: discord.Interaction, prefix: str = None):
         if not await self.is_bot_admin(interaction): return
 
-        users_map = await storage.get_all_users()
-        if not users_map:
+        # storage folds case the same way SQLite's lower() does
+        prefix = prefix.strip() if prefix else None
+        view = UserListView(interaction.user.id, prefix)
+        if not await view.load():
             await interaction.response.send_message("保存されているユーザーはいません。", ephemeral=True)
             return
+        await interaction.response.send_message(embed=view.build_embed(), view=view, ephemeral=True)
 
-        embed = discord.Embed(title=f"保存済みユーザー一覧 ({len(users_map)}名)", color=discord.Color.gold())
-        description = ""
-        for uid, data in users_map.items():
-            line = f"• <@{uid}> (`{uid}`) - {data.get('username')}\n"
-            if len(description) + len(line) > 4000:
-                description += "...(他多数)"
-                break
-            description += line
-        
-        embed.description = description
+    @discord.app_commands.command(name="stats", description="認証済みユーザーの統計を表示します")
+    async def stats(self, interaction: discord.Interaction):
+        if not await self.is_bot_admin(interaction): return
+
+        # Counted in the database from indexes, no user rows are loaded
+        started = time.perf_counter()
+        stats = await storage.get_user_stats()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        embed = discord.Embed(title="認証ユーザー統計", color=discord.Color.blurple())
+        embed.add_field(name="認証済みユーザー", value=f"{stats['total']}名", inline=True)
+        embed.add_field(name="24時間以内に期限切れ", value=f"{stats['expiring_24h']}名", inline=True)
+        embed.add_field(name="期限切れ", value=f"{stats['expired']}名", inline=True)
+        embed.add_field(name="トークン更新に失敗中",
+                        value=f"{stats['refresh_failing_users']}名 (計{stats['refresh_failures']}回)", inline=True)
+        embed.add_field(name="更新予定 (スケジューラ)", value=f"{len(self.bot.refresh_scheduler)}名", inline=True)
+        embed.set_footer(text=f"集計時間: {elapsed_ms:.1f} ms")
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @discord.app_commands.command(name="removeuser", description="指定ユーザーの認証データを削除します")
@@ -169,6 +305,7 @@ class AuthCog(commands.Cog):
         if not await self.is_bot_admin(interaction): return
         
         if await storage.remove_user(user.id):
+            self.bot.refresh_scheduler.unschedule(user.id)
             await interaction.response.send_message(f"{user.mention} の認証データを削除しました。これ以降 `/join` の対象になりません。", ephemeral=True)
         else:
             await interaction.response.send_message(f"{user.mention} のデータは見つかりませんでした。", ephemeral=True)
@@ -196,13 +333,18 @@ class AuthCog(commands.Cog):
     # --- Admin Helper Commands ---
 
     @discord.app_commands.command(name="sync", description="スラッシュコマンドをDiscordに同期します(管理者のみ)")
-    async def sync_commands(self, interaction: discord.Interaction):
+    @discord.app_commands.describe(force="変更がなくても同期します", guild_only="このサーバー専用のコマンドのみ同期します")
+    async def sync_commands(self, interaction: discord.Interaction, force: bool = False, guild_only: bool = False):
         if not await self.is_bot_admin(interaction): return
         
         await interaction.response.defer(ephemeral=True)
         try:
-            await self.bot.tree.sync()
-            await interaction.followup.send("スラッシュコマンドの同期が完了しました！反映まで時間がかかる場合があります。")
+            # Skips the upload (and its rate limit) when the command tree hasn't changed
+            synced = await sync_if_changed(self.bot.tree, guild=interaction.guild if guild_only else None, force=force)
+            if synced is None:
+                await interaction.followup.send("コマンドに変更がないため、同期をスキップしました。(強制する場合は force を指定)")
+                return
+            await interaction.followup.send(f"スラッシュコマンドの同期が完了しました！({synced}件) 反映まで時間がかかる場合があります。")
         except Exception as e:
             await interaction.followup.send(f"同期に失敗しました: {e}")
 
@@ -221,45 +363,69 @@ class AuthCog(commands.Cog):
             await self._perform_join(interaction, target.id, target.mention)
         else:
             # Bulk join logic
-            users_map = await storage.get_all_users()
-            if not users_map:
+            total = await storage.count_users()
+            if not total:
                 await interaction.followup.send("保存されているユーザーはいません。")
                 return
             
-            await interaction.followup.send(f"{len(users_map)} 名の参加処理を開始します...")
-            
-            success_count = 0
-            fail_count = 0
-            already_in_count = 0
-            
-            for uid_str, user_data in users_map.items():
-                uid = int(uid_str)
-                # Check if user is already in guild (to avoid wasting API calls)
-                if interaction.guild.get_member(uid):
-                    already_in_count += 1
-                    continue
-                
-                res = await self._perform_join_logic(interaction.guild.id, uid, user_data)
-                if res == "success":
-                    success_count += 1
-                elif res == "already_in":
-                    already_in_count += 1
-                else:
-                    fail_count += 1
-                
-                # Small sleep to be safe with rate limits during bulk
-                await asyncio.sleep(0.5)
-            
+            progress_msg = await interaction.followup.send(f"{total} 名の参加処理を開始します...", wait=True)
+            # Runs as a persistent job so a restart resumes with the remaining users
+            job_id = await self.join_jobs.start(
+                interaction.guild, interaction.channel_id, interaction.user.id, progress_msg
+            )
             await interaction.followup.send(
-                f"参加処理が完了しました。\n"
-                f"✅ 成功: {success_count}名\n"
-                f"🏠 既にサーバー内: {already_in_count}名\n"
-                f"❌ 失敗: {fail_count}名"
+                f"ジョブ `{job_id}` として実行中です。`/joinjob status` で確認、`/joinjob cancel` で中止できます。"
             )
 
+    # --- Join Job Commands ---
+
+    joinjob_group = discord.app_commands.Group(name="joinjob", description="一括参加ジョブの管理コマンド")
+
+    @joinjob_group.command(name="status", description="一括参加ジョブの状況を表示します")
+    @discord.app_commands.describe(job_id="ジョブID（省略すると最近のジョブ一覧）")
+    async def joinjob_status(self, interaction: discord.Interaction, job_id: str = None):
+        if not await self.is_bot_admin(interaction): return
+
+        if job_id:
+            job = await storage.get_join_job(job_id)
+            if not job:
+                await interaction.response.send_message(f"ジョブ `{job_id}` は見つかりませんでした。", ephemeral=True)
+                return
+            counts = job["counts"]
+            embed = discord.Embed(title=f"一括参加ジョブ `{job_id}`", description=format_counts(counts), color=discord.Color.blurple())
+            embed.add_field(name="状態", value=job["status"], inline=True)
+            embed.add_field(name="残り", value=f"{counts['pending']}名", inline=True)
+            embed.add_field(name="サーバー", value=f"`{job['guild_id']}`", inline=True)
+            embed.add_field(name="開始", value=f"<t:{int(job['created_at'])}:f>", inline=True)
+            embed.add_field(name="最終更新", value=f"<t:{int(job['updated_at'])}:R>", inline=True)
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+
+        jobs = await storage.get_join_jobs(limit=10)
+        if not jobs:
+            await interaction.response.send_message("一括参加ジョブはありません。", ephemeral=True)
+            return
+        lines = [
+            f"• `{job['job_id']}` - {job['status']} (<t:{int(job['created_at'])}:R>, サーバー `{job['guild_id']}`)"
+            for job in jobs
+        ]
+        embed = discord.Embed(title="最近の一括参加ジョブ", description="\n".join(lines), color=discord.Color.blurple())
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @joinjob_group.command(name="cancel", description="実行中の一括参加ジョブを中止します")
+    @discord.app_commands.describe(job_id="中止するジョブID")
+    async def joinjob_cancel(self, interaction: discord.Interaction, job_id: str):
+        if not await self.is_bot_admin(interaction): return
+
+        await interaction.response.defer(ephemeral=True)
+        if await self.join_jobs.cancel(job_id):
+            await interaction.followup.send(f"ジョブ `{job_id}` を中止しました。")
+        else:
+            await interaction.followup.send(f"実行中のジョブ `{job_id}` は見つかりませんでした。")
+
     async def _perform_join(self, interaction: discord.Interaction, user_id: int, mention: str):
         # Specific helper for single user with feedback
-        if interaction.guild.get_member(user_id):
+        if self.bot.is_member(interaction.guild, user_id):
              await interaction.followup.send(f"{mention} は既にサーバーにいます。")
              return
 
@@ -276,11 +442,16 @@ class AuthCog(commands.Cog):
         else:
             await interaction.followup.send(f"{mention} の参加処理に失敗しました。詳細: {res}")
 
-    async def _perform_join_logic(self, guild_id: int, user_id: int, user_data: dict) -> str:
+    async def _perform_join_logic(self, guild_id: int, user_id: int, user_data: UserRecord) -> str:
         # Core join logic returning status string
-        access_token = user_data["access_token"]
-        refresh_token = user_data["refresh_token"]
-        expires_at = user_data.get("expires_at", 0)
+        res = await self._join_request(guild_id, user_id, user_data)
+        metrics.JOIN_RESULTS.inc(result=res)
+        return res
+
+    async def _join_request(self, guild_id: int, user_id: int, user_data: UserRecord) -> str:
+        access_token = user_data.access_token
+        refresh_token = user_data.refresh_token
+        expires_at = user_data.expires_at
         
         if time.time() > expires_at - 60:
             new_access = await self.bot.refresh_user_token(user_id, refresh_token)
@@ -289,21 +460,14 @@ class AuthCog(commands.Cog):
             else:
                 return "token_refresh_failed"
 
-        url = f"https://discord.com/api/guilds/{guild_id}/members/{user_id}"
-        headers = {
-            "Authorization": f"Bot {config.BOT_TOKEN}",
-            "Content-Type": "application/json"
-        }
-        json_body = {"access_token": access_token}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.put(url, headers=headers, json=json_body) as resp:
-                if resp.status in (201, 204):
-                    return "success"
-                elif resp.status == 200:
-                    return "already_in"
-                else:
-                    return f"api_error_{resp.status}"
+        # The shared client paces the add-member bucket and retries 429s
+        resp = await discord_api.add_guild_member(guild_id, user_id, access_token)
+        if resp.status in (201, 204):
+            return "success"
+        elif resp.status == 200:
+            return "already_in"
+        else:
+            return f"api_error_{resp.status}"
 
 async def setup(bot):
     await bot.add_cog(AuthCog(bot))
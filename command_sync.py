@@ -0,0 +1,29 @@
+import hashlib
+import json
+import storage
+
+# Discord allows only a few command uploads per day before rate limiting, so
+# tree.sync() is skipped when the serialised tree matches the last upload.
+
+def tree_hash(tree, guild=None):
+    # Stable hash of what tree.sync(guild=guild) would upload
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+        key=lambda c: (c.get("type", 1), c["name"])
+    )
+    blob = json.dumps({"application_id": tree.client.application_id, "commands": payload},
+                      sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def _meta_key(guild):
+    return f"command_tree_hash:{guild.id}" if guild else "command_tree_hash"
+
+async def sync_if_changed(tree, guild=None, force=False):
+    # Returns the number of commands uploaded, or None when nothing changed
+    digest = tree_hash(tree, guild)
+    key = _meta_key(guild)
+    if not force and await storage.get_meta(key) == digest:
+        return None
+    synced = await tree.sync(guild=guild)
+    await storage.set_meta(key, digest)
+    return len(synced)
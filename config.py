@@ -1,4 +1,5 @@
 import os
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,3 +22,80 @@ TURSO_TOKEN = os.getenv("TURSO_TOKEN")
 
 if not REDIRECT_URI:
     REDIRECT_URI = "http://localhost:8080/callback"
+
+# Bulk /join tuning
+JOIN_CONCURRENCY = int(os.getenv("JOIN_CONCURRENCY", 5))
+JOIN_PROGRESS_INTERVAL = float(os.getenv("JOIN_PROGRESS_INTERVAL", 5))
+
+# Shared Discord REST client
+DISCORD_API_BASE = os.getenv("DISCORD_API_BASE", "https://discord.com/api")
+DISCORD_HTTP_LIMIT = int(os.getenv("DISCORD_HTTP_LIMIT", 100))
+DISCORD_HTTP_LIMIT_PER_HOST = int(os.getenv("DISCORD_HTTP_LIMIT_PER_HOST", 20))
+
+# Token refresh scheduling (seconds)
+REFRESH_MARGIN = int(os.getenv("REFRESH_MARGIN", 21600))  # Refresh 6 hours before expiry
+REFRESH_JITTER = int(os.getenv("REFRESH_JITTER", 3600))
+REFRESH_RETRY_DELAY = int(os.getenv("REFRESH_RETRY_DELAY", 1800))
+REFRESH_CONCURRENCY = int(os.getenv("REFRESH_CONCURRENCY", 5))
+
+# Storage caches (TTL in seconds)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", 60))
+
+# Write-behind batching for storage.save_user
+STORAGE_WRITE_BEHIND = os.getenv("STORAGE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", 200))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", 1.0))
+
+# Storage backend: "turso" (remote libSQL) or "sqlite" (local file)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "turso").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "verify-bot.db")
+
+# Key used to sign the OAuth `state` parameter (defaults to the client secret)
+STATE_SECRET = os.getenv("STATE_SECRET") or CLIENT_SECRET
+# Bare "role_id" states from pre-signing panels are forged trivially, so they are
+# rejected unless this is set to a date (YYYY-MM-DD, UTC) to accept them until,
+# while old panels are reposted
+_unsigned_until = os.getenv("ALLOW_UNSIGNED_STATE_UNTIL")
+ALLOW_UNSIGNED_STATE_UNTIL = (
+    datetime.fromisoformat(_unsigned_until).replace(tzinfo=timezone.utc).timestamp() if _unsigned_until else None
+)
+
+# Background pipeline for finishing OAuth verifications
+GRANT_WORKERS = int(os.getenv("GRANT_WORKERS", 4))
+GRANT_MAX_ATTEMPTS = int(os.getenv("GRANT_MAX_ATTEMPTS", 5))
+GRANT_STATUS_TTL = int(os.getenv("GRANT_STATUS_TTL", 600))
+
+# Concurrent add_roles workers per guild for the role-grant queue
+ROLE_GRANT_WORKERS = int(os.getenv("ROLE_GRANT_WORKERS", 2))
+
+# Deployment mode: "all" (gateway and web server in one process), "gateway"
+# (bot only, grants roles queued by web workers) or "web" (python web_worker.py)
+RUN_MODE = os.getenv("RUN_MODE", "all").lower()
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
+GRANT_RELAY_INTERVAL = float(os.getenv("GRANT_RELAY_INTERVAL", 1.0))
+# RUN_MODE=gateway serves its own /metrics and /debug/profile on this port
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+
+# Member cache: "full" (discord.py default) or "lean" (member IDs only, for very large guilds)
+MEMBER_CACHE = os.getenv("MEMBER_CACHE", "full").lower()
+
+# Sync slash commands at startup; skipped when the command tree is unchanged
+SYNC_COMMANDS_ON_START = os.getenv("SYNC_COMMANDS_ON_START", "true").lower() in ("1", "true", "yes")
+
+# Admission control for the OAuth /callback route
+CALLBACK_MAX_CONCURRENT = int(os.getenv("CALLBACK_MAX_CONCURRENT", 50))
+CALLBACK_MAX_QUEUE = int(os.getenv("CALLBACK_MAX_QUEUE", 200))
+CALLBACK_QUEUE_TIMEOUT = float(os.getenv("CALLBACK_QUEUE_TIMEOUT", 2.0))
+CALLBACK_RATE_PER_IP = float(os.getenv("CALLBACK_RATE_PER_IP", 0.2))  # Sustained requests per second
+CALLBACK_BURST_PER_IP = int(os.getenv("CALLBACK_BURST_PER_IP", 5))
+
+# Logging: level name, and keep 1 in N per-user log lines (refreshes, joins)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", 100))
+
+# Event-loop watchdog (seconds) and the token for /debug/profile (route disabled when unset)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 1.0))
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+import aiohttp
+import config
+import metrics
+from log_setup import SAMPLED
+
+log = logging.getLogger(__name__)
+
+class APIResponse:
+    __slots__ = ("status", "headers", "data")
+
+    def __init__(self, status, headers, data):
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+
+class RateLimitBucket:
+    # Paces requests on one Discord rate-limit bucket from the X-RateLimit-* /
+    # Retry-After headers. Callers await acquire() before each request and pass
+    # the response to update().
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._remaining = None   # Unknown until the first response
+        self._reset_at = 0.0     # monotonic time when the current window resets
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            if now >= self._reset_at:
+                # Window has reset, we don't know the new budget until the next response
+                self._remaining = None
+            elif self._remaining is not None and self._remaining <= 0:
+                await asyncio.sleep(self._reset_at - now)
+                self._remaining = None
+            if self._remaining is not None:
+                self._remaining -= 1
+
+    def update(self, status, headers, retry_after=None):
+        now = time.monotonic()
+        if status == 429:
+            self._remaining = 0
+            self._reset_at = max(self._reset_at, now + retry_after)
+            return
+
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None and reset_after is not None:
+            # Headers are authoritative; requests still in flight may lower it further
+            self._remaining = int(remaining)
+            self._reset_at = now + float(reset_after)
+
+
+class DiscordClient:
+    # One pooled aiohttp session for every REST call the bot makes outside of
+    # discord.py: OAuth token exchange/refresh, /users/@me and add-member.
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url or config.DISCORD_API_BASE
+        self._session = None
+        # route key -> Discord bucket hash (several routes can share one bucket)
+        self._bucket_hashes = {}
+        # (bucket hash or route key, major parameter) -> RateLimitBucket
+        self._buckets = {}
+        self._global_reset_at = 0.0
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.DISCORD_HTTP_LIMIT,
+                limit_per_host=config.DISCORD_HTTP_LIMIT_PER_HOST,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self._session
+
+    def _get_bucket(self, route, major):
+        key = (self._bucket_hashes.get(route, route), major)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = RateLimitBucket()
+        return bucket
+
+    async def request(self, method, path, route=None, major=None, per_token=False, max_retries=5,
+                      idempotent=True, **kwargs):
+        # route: path template shared by every call to this endpoint, e.g.
+        # "/guilds/{guild_id}/members/{user_id}". major: the major parameter
+        # (guild/channel ID) Discord scopes the bucket to. per_token: the route
+        # is limited per OAuth token, so there is no shared bucket to track.
+        # idempotent=False: the call must not be replayed once it may have
+        # reached Discord (single-use OAuth codes and refresh tokens), so only
+        # 429s, which Discord never processed, are retried.
+        route = f"{method} {route or path}"
+        session = self._get_session()
+        url = self.base_url + path
+
+        for attempt in range(max_retries + 1):
+            bucket = RateLimitBucket() if per_token else self._get_bucket(route, major)
+            await bucket.acquire()
+            delay = self._global_reset_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                with metrics.DISCORD_API_SECONDS.time(route=route):
+                    async with session.request(method, url, **kwargs) as resp:
+                        if resp.content_type == "application/json":
+                            data = await resp.json()
+                        else:
+                            data = await resp.text()
+                        response = APIResponse(resp.status, resp.headers, data)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == max_retries or not idempotent:
+                    raise
+                log.warning("Discord API %s connection error (%s), retrying", route, e, extra=SAMPLED)
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+
+            bucket_hash = response.headers.get("X-RateLimit-Bucket")
+            if bucket_hash and not per_token and self._bucket_hashes.get(route) != bucket_hash:
+                self._bucket_hashes[route] = bucket_hash
+                self._buckets.setdefault((bucket_hash, major), bucket)
+
+            if response.status == 429:
+                retry_after = self._retry_after(response, attempt)
+                is_global = response.headers.get("X-RateLimit-Global") == "true" or (
+                    isinstance(response.data, dict) and response.data.get("global")
+                )
+                metrics.DISCORD_API_RATE_LIMITED.inc(route=route, scope="global" if is_global else "bucket")
+                if is_global:
+                    self._global_reset_at = time.monotonic() + retry_after
+                else:
+                    bucket.update(429, response.headers, retry_after)
+                if attempt == max_retries:
+                    return response
+                log.info("Discord API %s rate limited, retrying in %.2fs", route, retry_after, extra=SAMPLED)
+                await asyncio.sleep(retry_after)
+                continue
+
+            bucket.update(response.status, response.headers)
+            if response.status >= 500 and idempotent and attempt < max_retries:
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            return response
+
+    def _retry_after(self, response, attempt):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is None and isinstance(response.data, dict):
+            retry_after = response.data.get("retry_after")
+        if retry_after is None:
+            # No hint from Discord, fall back to exponential backoff
+            return min(2 ** attempt, 30)
+        return float(retry_after)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# Global client
+client = None
+
+def get_client():
+    global client
+    if client is None:
+        client = DiscordClient()
+    return client
+
+async def close():
+    global client
+    if client is not None:
+        await client.close()
+        client = None
+
+# Endpoint helpers
+async def exchange_code(code):
+    data = {
+        'client_id': config.CLIENT_ID,
+        'client_secret': config.CLIENT_SECRET,
+        'grant_type': 'authorization_code',
+        'code': code,
+        'redirect_uri': config.REDIRECT_URI
+    }
+    return await get_client().request("POST", "/oauth2/token", idempotent=False, data=data)
+
+async def refresh_token(refresh_token):
+    data = {
+        'client_id': config.CLIENT_ID,
+        'client_secret': config.CLIENT_SECRET,
+        'grant_type': 'refresh_token',
+        'refresh_token': refresh_token
+    }
+    return await get_client().request("POST", "/oauth2/token", idempotent=False, data=data)
+
+async def get_current_user(access_token):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    return await get_client().request("GET", "/users/@me", per_token=True, headers=headers)
+
+async def add_guild_member(guild_id, user_id, access_token):
+    headers = {"Authorization": f"Bot {config.BOT_TOKEN}"}
+    return await get_client().request(
+        "PUT", f"/guilds/{guild_id}/members/{user_id}",
+        route="/guilds/{guild_id}/members/{user_id}", major=guild_id,
+        headers=headers, json={"access_token": access_token}
+    )
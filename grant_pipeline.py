@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import secrets
+import time
+from collections import OrderedDict
+import discord
+import config
+import discord_api
+import storage
+import metrics
+from models import UserRecord
+
+log = logging.getLogger(__name__)
+
+class GrantError(Exception):
+    # A failure that retrying won't fix; the message is shown to the user
+    pass
+
+
+class GrantJob:
+    __slots__ = ("job_id", "token_data", "expires_at", "role_id", "guild_id", "ip_address",
+                 "status", "message", "attempts", "saved", "created_at")
+
+    def __init__(self, token_data, role_id, guild_id, ip_address):
+        self.job_id = secrets.token_urlsafe(16)
+        self.token_data = token_data
+        self.expires_at = time.time() + token_data['expires_in']
+        self.role_id = role_id
+        self.guild_id = guild_id
+        self.ip_address = ip_address
+        self.status = "pending"  # pending -> done | failed | forwarded
+        self.message = None
+        self.attempts = 0
+        self.saved = False  # Storage write landed, skip it on retries
+        self.created_at = time.monotonic()
+
+
+class GrantPipeline:
+    # Finishes an OAuth verification after the callback has already answered
+    # the browser: profile fetch, storage write and role grant run on a pool of
+    # workers, with retries and backoff for transient errors. The page polls
+    # status() through /callback/status/{job_id}.
+    # Without a bot (RUN_MODE=web) the role grant is queued in storage for the
+    # gateway process instead.
+
+    def __init__(self, bot=None, workers=None, max_attempts=None, status_ttl=None):
+        self.bot = bot
+        self.worker_count = workers or config.GRANT_WORKERS
+        self.max_attempts = max_attempts or config.GRANT_MAX_ATTEMPTS
+        self.status_ttl = status_ttl or config.GRANT_STATUS_TTL
+        self._queue = asyncio.Queue()
+        self._jobs = OrderedDict()  # job_id -> GrantJob, oldest first
+        self._workers = []
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, token_data, role_id, guild_id, ip_address):
+        self._prune()
+        job = GrantJob(token_data, role_id, guild_id, ip_address)
+        self._jobs[job.job_id] = job
+        self._queue.put_nowait(job)
+        return job.job_id
+
+    def status(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return {"status": job.status, "message": job.message}
+
+    async def lookup(self, job_id):
+        # status(), falling back to the shared request table for forwarded grants.
+        # With several web workers the page may poll a worker that never saw the job.
+        status = self.status(job_id)
+        if self.bot is None and (status is None or status["status"] == "forwarded"):
+            stored = await storage.get_role_grant(job_id)
+            if stored is not None:
+                if stored["status"] not in ("done", "failed"):
+                    stored["status"] = "pending"
+                return stored
+            if status is not None:
+                status = {"status": "pending", "message": None}
+        return status
+
+    def _prune(self):
+        # Statuses only need to live long enough for the page to poll them
+        cutoff = time.monotonic() - self.status_ttl
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            if job.created_at > cutoff:
+                break
+            self._jobs.popitem(last=False)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.attempts += 1
+            try:
+                await self._process(job)
+                if job.status == "forwarded":
+                    metrics.GRANT_JOBS.inc(outcome="forwarded")
+                else:
+                    job.status = "done"
+                    metrics.GRANT_JOBS.inc(outcome="done")
+            except GrantError as e:
+                job.status = "failed"
+                job.message = str(e)
+                metrics.GRANT_JOBS.inc(outcome="failed")
+            except Exception as e:
+                if job.attempts >= self.max_attempts:
+                    log.warning("Grant job %s failed after %d attempts: %s", job.job_id, job.attempts, e)
+                    job.status = "failed"
+                    job.message = f"Role grant error: {e}"
+                    metrics.GRANT_JOBS.inc(outcome="failed")
+                else:
+                    metrics.GRANT_JOBS.inc(outcome="retried")
+                    # Re-queue later without holding up this worker
+                    delay = min(2 ** job.attempts, 30)
+                    asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job):
+        token_data = job.token_data
+        access_token = token_data['access_token']
+
+        # Fetch User ID & Profile
+        with metrics.CALLBACK_STAGE_SECONDS.time(stage="profile_fetch"):
+            user_resp = await discord_api.get_current_user(access_token)
+        if user_resp.status == 401:
+            raise GrantError("Error: Failed to fetch user profile from Discord.")
+        if user_resp.status != 200:
+            raise RuntimeError(f"users/@me returned {user_resp.status}")
+        user_data_api = user_resp.data
+        user_id = int(user_data_api['id'])
+        username = user_data_api.get('username')
+        avatar = user_data_api.get('avatar')
+        avatar_url = f"https://cdn.discordapp.com/avatars/{user_id}/{avatar}.png" if avatar else None
+
+        # Save to Storage
+        if not job.saved:
+            user = UserRecord(
+                user_id,
+                username=username,
+                avatar_url=avatar_url,
+                ip_address=job.ip_address,
+                access_token=access_token,
+                refresh_token=token_data['refresh_token'],
+                expires_at=job.expires_at
+            )
+            with metrics.CALLBACK_STAGE_SECONDS.time(stage="storage_write"):
+                await storage.save_user(user_id, user)
+            job.saved = True
+            if self.bot is not None:
+                self.bot.refresh_scheduler.schedule(user_id, job.expires_at)
+
+        if self.bot is None:
+            # Web worker: the gateway process grants the role (see grant_relay.py)
+            await storage.enqueue_role_grant(job.job_id, user_id, job.role_id, job.guild_id, job.expires_at)
+            job.status = "forwarded"
+            return
+
+        # The web server binds before the gateway is ready (see bot.py); until
+        # then bot.guilds is empty and grant_role would fail permanently
+        await self.bot.wait_until_ready()
+        await grant_role(self.bot, user_id, job.role_id, job.guild_id)
+
+
+async def grant_role(bot, user_id, role_id, guild_id):
+    # Raises GrantError when the role can't be granted; shared with grant_relay
+    if guild_id is None:
+        # Legacy states have no guild ID, look the role up in the role -> guild index
+        guild_id = bot.role_index.get(role_id)
+
+    target_guild = bot.get_guild(guild_id) if guild_id else None
+    target_role = target_guild.get_role(role_id) if target_guild else None
+    target_member = await bot.resolve_member(target_guild, user_id) if target_role else None
+
+    if not (target_guild and target_role and target_member):
+        raise GrantError("Error: Could not find the server, member, or role. Please ensure you share a server with the bot.")
+
+    if target_member.get_role(target_role.id):
+        return  # Already verified
+
+    try:
+        # Goes through the shared per-guild queue, paced with panel clicks
+        with metrics.CALLBACK_STAGE_SECONDS.time(stage="role_grant"):
+            await bot.role_grants.grant(target_member, target_role)
+    except discord.Forbidden as e:
+        raise GrantError(f"Role grant error: {e}")
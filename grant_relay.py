@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+import config
+import storage
+import metrics
+from grant_pipeline import GrantError, grant_role
+
+log = logging.getLogger(__name__)
+
+class RoleGrantRelay:
+    # Gateway side of RUN_MODE=gateway/web. Web workers save the user and queue
+    # a row in role_grant_requests; this polls the table and grants the roles
+    # through the bot's per-guild queue. The page reads the row's status back
+    # through any web worker.
+
+    def __init__(self, bot, interval=None, batch_size=50, max_attempts=None):
+        self.bot = bot
+        self.interval = interval or config.GRANT_RELAY_INTERVAL
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts or config.GRANT_MAX_ATTEMPTS
+        self._inflight = set()
+        self._task = None
+
+    async def start(self):
+        await storage.requeue_role_grants()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._inflight)
+        if self._task:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        last_prune = 0.0
+        while True:
+            try:
+                # Role grants need the guild cache, wait for the gateway
+                await self.bot.wait_until_ready()
+                room = self.batch_size - len(self._inflight)
+                requests = await storage.claim_role_grants(room) if room > 0 else []
+                for request in requests:
+                    task = asyncio.create_task(self._process(request))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._inflight.discard)
+                if time.time() - last_prune > 3600:
+                    last_prune = time.time()
+                    await storage.prune_role_grants(last_prune - 86400)
+            except Exception as e:
+                log.error("Role grant relay poll failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def _process(self, request):
+        job_id = request["job_id"]
+        user_id = request["user_id"]
+        # The web worker wrote this user; don't serve an older cached row
+        storage.invalidate_user(user_id)
+        if request["expires_at"]:
+            self.bot.refresh_scheduler.schedule(user_id, request["expires_at"])
+        try:
+            await grant_role(self.bot, user_id, request["role_id"], request["guild_id"])
+            await storage.finish_role_grant(job_id, "done")
+            metrics.GRANT_JOBS.inc(outcome="done")
+        except GrantError as e:
+            await storage.finish_role_grant(job_id, "failed", str(e))
+            metrics.GRANT_JOBS.inc(outcome="failed")
+        except Exception as e:
+            if request["attempts"] >= self.max_attempts:
+                log.warning("Grant job %s failed after %d attempts: %s", job_id, request['attempts'], e)
+                await storage.finish_role_grant(job_id, "failed", f"Role grant error: {e}")
+                metrics.GRANT_JOBS.inc(outcome="failed")
+            else:
+                metrics.GRANT_JOBS.inc(outcome="retried")
+                await storage.retry_role_grant(job_id, min(2 ** request["attempts"], 30))
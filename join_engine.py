@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import config
+from log_setup import SAMPLED
+
+log = logging.getLogger(__name__)
+
+class BulkJoinEngine:
+    # Runs join_func(user_id, user_data) -> status string over many users with
+    # bounded concurrency, reporting progress through an optional async callback.
+    # on_result(user_id, res) is called synchronously for every finished user.
+
+    def __init__(self, join_func, concurrency=None, on_progress=None, progress_interval=None, on_result=None):
+        self.join_func = join_func
+        self.on_result = on_result
+        self.concurrency = concurrency or config.JOIN_CONCURRENCY
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval or config.JOIN_PROGRESS_INTERVAL
+        self.counts = {"success": 0, "already_in": 0, "failed": 0}
+        self.done = 0
+        self.total = 0
+
+    def _record(self, user_id, res):
+        if res == "success":
+            self.counts["success"] += 1
+        elif res == "already_in":
+            self.counts["already_in"] += 1
+        else:
+            self.counts["failed"] += 1
+        self.done += 1
+        if self.on_result:
+            self.on_result(user_id, res)
+
+    def skip_already_in(self, user_id):
+        # For users filtered out before any API call (e.g. found in the member cache)
+        self._record(user_id, "already_in")
+
+    async def _worker(self, queue):
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                user_id, user_data = item
+                try:
+                    res = await self.join_func(user_id, user_data)
+                except Exception as e:
+                    log.warning("Join failed for %s: %s", user_id, e, extra=SAMPLED)
+                    res = "error"
+                self._record(user_id, res)
+            finally:
+                queue.task_done()
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await self.on_progress(self)
+            except Exception as e:
+                log.warning("Failed to report join progress: %s", e)
+
+    async def run(self, users, total=None):
+        # users: iterable or async iterable of (user_id, user_data). The queue is
+        # bounded so that producers never run far ahead of the workers.
+        self.total = total or 0
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report_progress()) if self.on_progress else None
+
+        try:
+            if hasattr(users, "__aiter__"):
+                async for item in users:
+                    await queue.put(item)
+            else:
+                for item in users:
+                    await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            tasks = workers + [reporter] if reporter else workers
+            for task in tasks:
+                task.cancel()
+            # Wait them out so no progress callback is still running when we return
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return self.counts
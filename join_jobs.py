@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import discord
+import storage
+from join_engine import BulkJoinEngine
+
+log = logging.getLogger(__name__)
+
+def item_status(res):
+    # join_job_items.status for a _perform_join_logic result string
+    if res in ("success", "already_in"):
+        return res
+    return "failed"
+
+def format_counts(counts):
+    return (
+        f"✅ 成功: {counts['success']}名\n"
+        f"🏠 既にサーバー内: {counts['already_in']}名\n"
+        f"❌ 失敗: {counts['failed']}名"
+    )
+
+
+class JoinJobManager:
+    # Runs bulk /join as persistent jobs. Every finished user is checkpointed to
+    # join_job_items on each progress tick, so after a restart resume_all()
+    # picks the job up with only the users that are still pending.
+
+    def __init__(self, cog):
+        self.cog = cog
+        self.bot = cog.bot
+        self._tasks = {}        # job_id -> asyncio.Task
+        self._cancelled = set()  # job_ids cancelled by an admin (vs. shutdown)
+
+    def is_running(self, job_id):
+        return job_id in self._tasks
+
+    async def start(self, guild, channel_id, requested_by, progress_msg=None):
+        job_id = await storage.create_join_job(guild.id, channel_id, requested_by)
+        self._launch(job_id, guild, channel_id, requested_by, progress_msg)
+        return job_id
+
+    async def resume_all(self):
+        for job in await storage.get_join_jobs(status="running", limit=100):
+            if job["job_id"] in self._tasks:
+                continue
+            guild = self.bot.get_guild(job["guild_id"])
+            if guild is None:
+                log.warning("Join job %s: guild %s unavailable, not resuming", job['job_id'], job['guild_id'])
+                continue
+            log.info("Resuming join job %s", job['job_id'])
+            self._launch(job["job_id"], guild, job["channel_id"], job["requested_by"])
+
+    async def cancel(self, job_id):
+        job = await storage.get_join_job(job_id)
+        if job is None or job["status"] != "running":
+            return False
+        task = self._tasks.get(job_id)
+        if task:
+            self._cancelled.add(job_id)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        else:
+            await storage.finish_join_job(job_id, "cancelled")
+        return True
+
+    async def stop(self):
+        # Shutdown: checkpoint and leave the jobs 'running' so they resume
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _launch(self, job_id, guild, channel_id, requested_by, progress_msg=None):
+        task = asyncio.create_task(self._run(job_id, guild, channel_id, requested_by, progress_msg))
+        self._tasks[job_id] = task
+
+    async def _run(self, job_id, guild, channel_id, requested_by, progress_msg):
+        base = {}
+        total = 0
+        results = []
+        checkpoint_lock = asyncio.Lock()
+
+        def on_result(user_id, res):
+            results.append((user_id, item_status(res), res))
+
+        async def checkpoint():
+            # Results leave the list only once saved; a failed or cancelled save
+            # is retried (the UPDATEs are idempotent) by the next checkpoint
+            async with checkpoint_lock:
+                batch = results[:]
+                await storage.save_join_results(job_id, batch)
+                del results[:len(batch)]
+
+        async def report_progress(engine):
+            await checkpoint()
+            if progress_msg:
+                done = total - base["pending"] + engine.done
+                counts = {k: base[k] + engine.counts[k] for k in ("success", "already_in", "failed")}
+                await progress_msg.edit(content=f"参加処理中 (ジョブ `{job_id}`)... {done}/{total}\n{format_counts(counts)}")
+
+        async def join_one(uid, user_data):
+            return await self.cog._perform_join_logic(guild.id, uid, user_data)
+
+        engine = BulkJoinEngine(join_one, on_progress=report_progress, on_result=on_result)
+
+        async def pending_users():
+            async for uid_str, user_data in storage.iter_pending_join_items(job_id):
+                uid = int(uid_str)
+                # Check if user is already in guild (to avoid wasting API calls)
+                if self.bot.is_member(guild, uid):
+                    engine.skip_already_in(uid)
+                    continue
+                yield uid, user_data
+
+        try:
+            base = await storage.get_join_job_counts(job_id)
+            total = sum(base.values())
+            await engine.run(pending_users(), total=total)
+            await checkpoint()
+            await storage.finish_join_job(job_id, "completed")
+        except asyncio.CancelledError:
+            await checkpoint()
+            if job_id in self._cancelled:
+                self._cancelled.discard(job_id)
+                await storage.finish_join_job(job_id, "cancelled")
+                await self._announce(job_id, channel_id, requested_by, progress_msg, "参加処理をキャンセルしました。")
+            raise
+        except Exception:
+            # Nothing awaits this task, so the job has to be closed out here or
+            # it stays 'running' with a frozen progress message until a restart
+            log.exception("Join job %s failed", job_id)
+            try:
+                await checkpoint()
+                await storage.finish_join_job(job_id, "failed")
+                await self._announce(job_id, channel_id, requested_by, progress_msg, "参加処理がエラーで中断されました。")
+            except Exception as e:
+                log.error("Join job %s: could not record failure: %s", job_id, e)
+            return
+        finally:
+            self._tasks.pop(job_id, None)
+
+        await self._announce(job_id, channel_id, requested_by, progress_msg, "参加処理が完了しました。")
+
+    async def _announce(self, job_id, channel_id, requested_by, progress_msg, header):
+        counts = await storage.get_join_job_counts(job_id)
+        result = f"{header} (ジョブ `{job_id}`)\n{format_counts(counts)}"
+        if progress_msg:
+            try:
+                await progress_msg.edit(content=result)
+                return
+            except discord.HTTPException:
+                pass  # Interaction tokens expire after 15 minutes, fall back to the channel
+        channel = self.bot.get_channel(channel_id) if channel_id else None
+        if channel:
+            mention = f"<@{requested_by}> " if requested_by else ""
+            try:
+                await channel.send(f"{mention}{result}")
+            except discord.HTTPException as e:
+                log.warning("Failed to announce join job %s: %s", job_id, e)
@@ -0,0 +1,61 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+import config
+
+# Log records are put on a queue by the event loop and written to stdout by a
+# listener thread, so a full container log pipe never blocks the loop.
+# Lines logged once per user pass extra=SAMPLED and only 1 in
+# LOG_SAMPLE_EVERY of them is kept (errors always are).
+
+SAMPLED = {"sampled": True}
+
+_listener = None
+_listener_pid = None  # A forked child inherits _listener but not its thread
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self._seen = 0
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False) or record.levelno >= logging.ERROR:
+            return True
+        self._seen += 1
+        return (self._seen - 1) % self.every == 0
+
+
+def setup_logging(level=None):
+    # Idempotent per process; call before starting the bot or web worker, and
+    # again in forked children, which need a listener thread of their own
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s %(name)s: %(message)s"))
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    handler.addFilter(SamplingFilter(config.LOG_SAMPLE_EVERY))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level or config.LOG_LEVEL)
+
+    _listener = QueueListener(records, stream, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    # Drains queued records; safe to call more than once
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        _listener = None
+        _listener_pid = None
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+import config
+import metrics
+
+log = logging.getLogger(__name__)
+
+class LoopLagMonitor:
+    # Measures event-loop lag with a sleeping heartbeat task, and runs a
+    # watchdog thread that logs the loop thread's stack when the heartbeat
+    # stops for longer than stall_threshold, i.e. while something is blocking
+    # the loop. Each stall is logged once.
+
+    def __init__(self, interval=None, stall_threshold=None):
+        self.interval = interval or config.LOOP_LAG_INTERVAL
+        self.stall_threshold = stall_threshold or config.LOOP_STALL_THRESHOLD
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            self._heartbeat = time.monotonic()
+            metrics.LOOP_LAG_SECONDS.observe(max(lag, 0.0))
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self._heartbeat
+            stalled = time.monotonic() - beat
+            if stalled < self.stall_threshold or reported == beat:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)"
+            log.warning("Event loop blocked for %.2fs, loop thread stack:\n%s", stalled, stack)
+
+
+def sample_stacks(thread_id, seconds, interval=0.005):
+    # Blocking sampling profiler, run it off the sampled thread (asyncio.to_thread).
+    # Returns (sample count, Counter of folded stacks "file:func;file:func").
+    stacks = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+            samples += 1
+        time.sleep(interval)
+    return samples, stacks
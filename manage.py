@@ -0,0 +1,84 @@
+"""Maintenance commands for the bot's database.
+
+Usage:
+    python manage.py export backup.ndjson.gz
+    python manage.py import backup.ndjson.gz
+
+Exports are gzip-compressed NDJSON: one user per line (the UserRecord
+fields), plus one {"admin": "<user_id>"} line per bot admin. Both commands
+stream in chunks, so memory stays flat for any table size, and imports are
+written as batched upserts into whichever backend config selects.
+"""
+import argparse
+import asyncio
+import gzip
+import time
+import models
+import storage
+
+CHUNK_SIZE = 1000
+
+
+async def export_db(path):
+    started = time.perf_counter()
+    users = 0
+    with gzip.open(path, "wb", compresslevel=6) as out:
+        lines = []
+        async for _, user in storage.iter_users(chunk_size=CHUNK_SIZE):
+            lines.append(models.dumps(user))
+            if len(lines) >= CHUNK_SIZE:
+                out.write(b"\n".join(lines) + b"\n")
+                users += len(lines)
+                lines = []
+        if lines:
+            out.write(b"\n".join(lines) + b"\n")
+            users += len(lines)
+
+        admins = await storage.get_admins()
+        for admin_id in admins:
+            out.write(models.encode({"admin": str(admin_id)}) + b"\n")
+
+    print(f"Exported {users} users and {len(admins)} admins to {path} in {time.perf_counter() - started:.2f}s")
+
+
+async def import_db(path):
+    started = time.perf_counter()
+    admins = []
+    counts = {"users": 0}
+
+    def records(src):
+        # Read lazily; save_users pulls one chunk at a time
+        for line in src:
+            if not line.strip():
+                continue
+            obj = models.decode(line)
+            if "admin" in obj:
+                admins.append(obj["admin"])
+                continue
+            counts["users"] += 1
+            record = models.UserRecord.from_dict(obj)
+            yield record.user_id, record
+
+    with gzip.open(path, "rb") as src:
+        await storage.save_users(records(src), chunk_size=CHUNK_SIZE)
+    for admin_id in admins:
+        await storage.add_admin(admin_id)
+
+    print(f"Imported {counts['users']} users and {len(admins)} admins from {path} in {time.perf_counter() - started:.2f}s")
+
+
+async def main(args):
+    try:
+        if args.command == "export":
+            await export_db(args.path)
+        else:
+            await import_db(args.path)
+    finally:
+        await storage.close_storage()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="gzip-compressed NDJSON file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,139 @@
+from array import array
+
+_EMPTY = 0
+_DELETED = 1  # Snowflakes are never 0 or 1, so both work as slot markers
+_GOLDEN = 0x9E3779B97F4A7C15
+_U64 = (1 << 64) - 1
+
+
+class MemberIDSet:
+    # Open-addressing hash set of member IDs in one array('Q'): about 12-24
+    # bytes per member against ~100 for a Python set of ints, and far less than
+    # a cached discord.Member. Linear probing with Fibonacci hashing, since the
+    # low bits of snowflakes (the per-millisecond increment) are mostly zero.
+
+    __slots__ = ("_slots", "_shift", "_used", "_filled")
+
+    def __init__(self, capacity=0):
+        bits = 3
+        while (1 << bits) * 7 < capacity * 10:
+            bits += 1
+        self._alloc(bits)
+
+    def _alloc(self, bits):
+        self._slots = array("Q", bytes(8 << bits))
+        self._shift = 64 - bits
+        self._used = 0    # Live IDs
+        self._filled = 0  # Live IDs + deleted markers
+
+    def __len__(self):
+        return self._used
+
+    def __iter__(self):
+        return (v for v in self._slots if v > _DELETED)
+
+    def __contains__(self, member_id):
+        slots = self._slots
+        mask = len(slots) - 1
+        i = ((member_id * _GOLDEN) & _U64) >> self._shift
+        while True:
+            v = slots[i]
+            if v == member_id:
+                return True
+            if v == _EMPTY:
+                return False
+            i = (i + 1) & mask
+
+    def add(self, member_id):
+        if (self._filled + 1) * 10 > len(self._slots) * 7:
+            self._resize(self._used + 1)
+        slots = self._slots
+        mask = len(slots) - 1
+        i = ((member_id * _GOLDEN) & _U64) >> self._shift
+        free = -1
+        while True:
+            v = slots[i]
+            if v == member_id:
+                return
+            if v == _EMPTY:
+                break
+            if v == _DELETED and free < 0:
+                free = i
+            i = (i + 1) & mask
+        if free < 0:
+            free = i
+            self._filled += 1
+        slots[free] = member_id
+        self._used += 1
+
+    def discard(self, member_id):
+        slots = self._slots
+        mask = len(slots) - 1
+        i = ((member_id * _GOLDEN) & _U64) >> self._shift
+        while True:
+            v = slots[i]
+            if v == member_id:
+                slots[i] = _DELETED
+                self._used -= 1
+                return
+            if v == _EMPTY:
+                return
+            i = (i + 1) & mask
+
+    def _resize(self, needed):
+        live = list(self)
+        bits = 3
+        while (1 << bits) * 7 < needed * 15:  # Leave room to grow by ~50%
+            bits += 1
+        self._alloc(bits)
+        for member_id in live:
+            self.add(member_id)
+
+
+class MemberIndex:
+    # guild_id -> MemberIDSet, used instead of discord.py's member cache when
+    # MEMBER_CACHE=lean. Filled by chunking each guild once and kept current
+    # from member join/remove events wired up in AuthBot.
+    # contains() returns None for guilds that haven't finished chunking.
+
+    def __init__(self):
+        self._guilds = {}
+        self._loading = set()
+
+    def __len__(self):
+        return sum(len(members) for members in self._guilds.values())
+
+    def is_loaded(self, guild_id):
+        return guild_id in self._guilds and guild_id not in self._loading
+
+    def contains(self, guild_id, member_id):
+        if not self.is_loaded(guild_id):
+            return None
+        return member_id in self._guilds[guild_id]
+
+    def begin_load(self, guild_id):
+        # Events that arrive while the guild is chunking still land in the set
+        self._guilds[guild_id] = MemberIDSet()
+        self._loading.add(guild_id)
+
+    def finish_load(self, guild_id, member_ids):
+        members = self._guilds.get(guild_id)
+        if members is None:
+            return  # Guild was removed mid-chunk
+        for member_id in member_ids:
+            members.add(member_id)
+        self._loading.discard(guild_id)
+
+    def add(self, guild_id, member_id):
+        members = self._guilds.get(guild_id)
+        if members is not None:
+            members.add(member_id)
+
+    def discard(self, guild_id, member_id):
+        members = self._guilds.get(guild_id)
+        if members is not None:
+            members.discard(member_id)
+
+    def remove_guild(self, guild_id):
+        self._guilds.pop(guild_id, None)
+        self._loading.discard(guild_id)
@@ -0,0 +1,112 @@
+import time
+from contextlib import contextmanager
+
+# Minimal Prometheus-style metrics, rendered in the text exposition format by
+# the /metrics route. Everything runs on the event loop, so no locking.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, state in self._values.items():
+            cumulative = 0
+            labels = _format_labels(self.label_names, key)
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {state[-1]}")
+            lines.append(f"{self.name}_sum{labels} {state[-2]}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Metrics used across the bot ---
+
+CALLBACK_REQUESTS = Counter(
+    "callback_requests_total", "OAuth /callback requests by outcome", ("outcome",))
+CALLBACK_STAGE_SECONDS = Histogram(
+    "callback_stage_seconds", "Latency of each OAuth verification stage", ("stage",))
+DISCORD_API_SECONDS = Histogram(
+    "discord_api_request_seconds", "Discord REST call latency by route", ("route",))
+DISCORD_API_RATE_LIMITED = Counter(
+    "discord_api_rate_limited_total", "Discord REST 429 responses by route", ("route", "scope"))
+STORAGE_QUERY_SECONDS = Histogram(
+    "storage_query_seconds", "Storage query latency by operation", ("operation",))
+TOKEN_REFRESHES = Counter(
+    "token_refresh_total", "Token refresh attempts by outcome", ("outcome",))
+GRANT_JOBS = Counter(
+    "grant_jobs_total", "Background role-grant jobs by outcome", ("outcome",))
+JOIN_RESULTS = Counter(
+    "join_results_total", "Guild join attempts by result", ("result",))
+LOOP_LAG_SECONDS = Histogram(
+    "event_loop_lag_seconds", "Event loop scheduling lag per heartbeat",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
@@ -0,0 +1,104 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # Optional speedup, the stdlib encoder produces the same JSON
+    orjson = None
+
+# Column order of the users table (after user_id), shared with storage.py
+USER_FIELDS = ("username", "avatar_url", "ip_address", "access_token", "refresh_token", "expires_at")
+
+
+class UserRecord:
+    # One stored user. __slots__ makes this roughly a third the size of the
+    # equivalent dict, which adds up in /join and the refresh task that stream
+    # every user. get()/[]/update() keep code written against the old user
+    # dicts working.
+
+    __slots__ = ("user_id",) + USER_FIELDS
+
+    def __init__(self, user_id, username=None, avatar_url=None, ip_address=None,
+                 access_token=None, refresh_token=None, expires_at=0):
+        self.user_id = int(user_id)
+        self.username = username
+        self.avatar_url = avatar_url
+        self.ip_address = ip_address
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at or 0
+
+    @classmethod
+    def from_row(cls, user_id, row, columns=USER_FIELDS):
+        # row holds `columns` in order, as selected from the users table
+        if columns is USER_FIELDS:
+            return cls(user_id, *row)
+        return cls(user_id, **dict(zip(columns, row)))
+
+    @classmethod
+    def from_dict(cls, data, user_id=None):
+        # Accepts the legacy JSON blob layout; unknown keys are ignored
+        if user_id is None:
+            user_id = data["user_id"]
+        return cls(user_id, *(data.get(field) for field in USER_FIELDS))
+
+    def to_dict(self):
+        data = {"user_id": self.user_id}
+        for field in USER_FIELDS:
+            data[field] = getattr(self, field)
+        return data
+
+    def to_params(self):
+        # Parameters for storage.SAVE_USER_SQL
+        return (str(self.user_id), self.username, self.avatar_url, self.ip_address,
+                self.access_token, self.refresh_token, self.expires_at or 0)
+
+    def copy(self):
+        return UserRecord(self.user_id, self.username, self.avatar_url, self.ip_address,
+                          self.access_token, self.refresh_token, self.expires_at)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def update(self, data=(), **kwargs):
+        for key, value in dict(data, **kwargs).items():
+            self[key] = value
+
+    def __eq__(self, other):
+        if not isinstance(other, UserRecord):
+            return NotImplemented
+        return all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+
+    def __repr__(self):
+        return f"<UserRecord user_id={self.user_id} username={self.username!r}>"
+
+
+def encode(obj):
+    # Compact JSON bytes for one NDJSON line
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+def decode(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(record):
+    # One user as a JSON object, the same keys as the legacy blob
+    return encode(record.to_dict())
+
+def loads(data):
+    return UserRecord.from_dict(decode(data))
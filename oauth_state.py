@@ -0,0 +1,35 @@
+import base64
+import hashlib
+import hmac
+import time
+import config
+
+# OAuth `state` format: "role_id:guild_id:signature". The signature is an HMAC
+# over "role_id:guild_id" so the callback can trust the guild ID without
+# searching for the role. Panels posted before this format carry a bare
+# "role_id"; parse_state only accepts those (guild_id is then None) until
+# config.ALLOW_UNSIGNED_STATE_UNTIL, since anyone can forge them.
+
+def _sign(payload):
+    secret = (config.STATE_SECRET or "").encode()
+    digest = hmac.new(secret, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).rstrip(b"=").decode()
+
+def make_state(role_id, guild_id):
+    payload = f"{role_id}:{guild_id}"
+    return f"{payload}:{_sign(payload)}"
+
+def parse_state(state):
+    # Returns (role_id, guild_id); raises ValueError if malformed or tampered with
+    parts = state.split(":")
+    if len(parts) == 1:
+        until = config.ALLOW_UNSIGNED_STATE_UNTIL
+        if until is None or time.time() >= until:
+            raise ValueError("Unsigned state")
+        return int(parts[0]), None
+    if len(parts) != 3:
+        raise ValueError("Invalid state format")
+    role_id, guild_id, signature = parts
+    if not hmac.compare_digest(signature, _sign(f"{role_id}:{guild_id}")):
+        raise ValueError("Invalid state signature")
+    return int(role_id), int(guild_id)
@@ -0,0 +1,54 @@
+import heapq
+import logging
+import random
+import time
+import config
+import storage
+
+log = logging.getLogger(__name__)
+
+class TokenRefreshScheduler:
+    # Min-heap of (refresh_at, user_id) so each tick only touches the tokens
+    # that are actually due. refresh_at is spread with random jitter so tokens
+    # saved together don't all come due in the same tick.
+    # Rescheduling a user pushes a new entry; the old one is skipped when popped
+    # because it no longer matches self._scheduled.
+
+    def __init__(self, margin=None, jitter=None):
+        self.margin = config.REFRESH_MARGIN if margin is None else margin
+        self.jitter = config.REFRESH_JITTER if jitter is None else jitter
+        self._heap = []
+        self._scheduled = {}  # user_id -> refresh_at of its live heap entry
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def schedule(self, user_id, expires_at):
+        refresh_at = expires_at - self.margin - random.uniform(0, self.jitter)
+        self.schedule_at(user_id, refresh_at)
+
+    def schedule_at(self, user_id, refresh_at):
+        user_id = int(user_id)
+        self._scheduled[user_id] = refresh_at
+        heapq.heappush(self._heap, (refresh_at, user_id))
+
+    def unschedule(self, user_id):
+        self._scheduled.pop(int(user_id), None)
+
+    def pop_due(self, now=None):
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            refresh_at, user_id = heapq.heappop(self._heap)
+            if self._scheduled.get(user_id) != refresh_at:
+                continue  # Stale entry, user was rescheduled or removed
+            del self._scheduled[user_id]
+            due.append(user_id)
+        return due
+
+    async def load(self):
+        # One pass over storage at startup, after that the heap is kept current
+        # by schedule() calls from the OAuth callback and successful refreshes.
+        async for user_id, user_data in storage.iter_users(columns=("expires_at",)):
+            self.schedule(user_id, user_data.expires_at)
+        log.info("Token refresh scheduler loaded %d users", len(self))
@@ -0,0 +1,91 @@
+import asyncio
+import config
+
+class RoleGrantQueue:
+    # Per-guild queues for add_roles so a burst of verification clicks is
+    # acknowledged immediately and granted by a few workers per guild. Role
+    # edits share one rate-limit bucket per guild, which discord.py's HTTP
+    # client already waits on, so a small worker count keeps each guild at
+    # its limit without piling up concurrent 429 retries.
+    # Duplicate requests for the same (guild, member, role) share one future.
+
+    def __init__(self, workers_per_guild=None, idle_timeout=60):
+        self.workers_per_guild = workers_per_guild or config.ROLE_GRANT_WORKERS
+        self.idle_timeout = idle_timeout
+        self._queues = {}   # guild_id -> asyncio.Queue
+        self._workers = {}  # guild_id -> set of worker tasks
+        self._pending = {}  # (guild_id, member_id, role_id) -> asyncio.Future
+
+    def pending_count(self, guild_id=None):
+        if guild_id is None:
+            return len(self._pending)
+        return sum(1 for key in self._pending if key[0] == guild_id)
+
+    def submit(self, member, role):
+        # Returns (future, queued). queued is False when the same grant is
+        # already waiting; the caller then shares the existing future.
+        key = (member.guild.id, member.id, role.id)
+        future = self._pending.get(key)
+        if future is not None:
+            return future, False
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        queue = self._queues.get(key[0])
+        if queue is None:
+            queue = self._queues[key[0]] = asyncio.Queue()
+            self._workers[key[0]] = set()
+        queue.put_nowait((key, member, role))
+        self._ensure_workers(key[0])
+        return future, True
+
+    async def grant(self, member, role):
+        future, _ = self.submit(member, role)
+        return await asyncio.shield(future)
+
+    def _ensure_workers(self, guild_id):
+        workers = self._workers[guild_id]
+        while len(workers) < self.workers_per_guild:
+            task = asyncio.create_task(self._worker(guild_id))
+            workers.add(task)
+            task.add_done_callback(workers.discard)
+
+    async def _worker(self, guild_id):
+        queue = self._queues[guild_id]
+        while True:
+            try:
+                key, member, role = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                # Idle guild, drop its queue once the last worker leaves
+                workers = self._workers.get(guild_id)
+                if workers is not None:
+                    workers.discard(asyncio.current_task())
+                if not workers and queue.empty() and self._queues.get(guild_id) is queue:
+                    del self._queues[guild_id]
+                    self._workers.pop(guild_id, None)
+                return
+
+            future = self._pending.get(key)
+            try:
+                await member.add_roles(role)
+                if future and not future.done():
+                    future.set_result(True)
+            except Exception as e:
+                if future and not future.done():
+                    future.set_exception(e)
+                    # Nobody may await it (fire-and-forget callers); don't warn about that
+                    future.exception()
+            finally:
+                self._pending.pop(key, None)
+                queue.task_done()
+
+    async def stop(self):
+        tasks = [t for workers in self._workers.values() for t in workers]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._queues.clear()
+        self._workers.clear()
@@ -0,0 +1,32 @@
+class RoleIndex:
+    # role_id -> guild_id for every guild the bot is in, so the OAuth callback
+    # can find a role's guild in O(1). Kept current from the gateway events
+    # wired up in AuthBot.
+
+    def __init__(self):
+        self._guild_by_role = {}
+
+    def __len__(self):
+        return len(self._guild_by_role)
+
+    def get(self, role_id):
+        return self._guild_by_role.get(role_id)
+
+    def rebuild(self, guilds):
+        self._guild_by_role = {}
+        for guild in guilds:
+            self.add_guild(guild)
+
+    def add_guild(self, guild):
+        for role in guild.roles:
+            self._guild_by_role[role.id] = guild.id
+
+    def remove_guild(self, guild):
+        for role in guild.roles:
+            self._guild_by_role.pop(role.id, None)
+
+    def add_role(self, role):
+        self._guild_by_role[role.id] = role.guild.id
+
+    def remove_role(self, role):
+        self._guild_by_role.pop(role.id, None)
@@ -1,16 +1,31 @@
+import asyncio
+import hmac
+import threading
 from aiohttp import web
-import aiohttp
 import config
-import storage
-import discord
-import time
+import discord_api
+from oauth_state import parse_state
+import metrics
+from admission import CallbackAdmission, client_ip
+from loop_monitor import sample_stacks
 
 routes = web.RouteTableDef()
+diagnostics_routes = web.RouteTableDef()  # /metrics and /debug/profile
 
-def setup_server(bot):
-    app = web.Application()
+def setup_server(bot, grant_pipeline=None):
+    # bot is None in a standalone web worker (RUN_MODE=web), which brings its own pipeline
+    app = web.Application(middlewares=[CallbackAdmission().middleware])
     app.add_routes(routes)
+    app.add_routes(diagnostics_routes)
     app["bot"] = bot
+    app["grant_pipeline"] = grant_pipeline or bot.grant_pipeline
+    return app
+
+def setup_diagnostics_server():
+    # RUN_MODE=gateway has no OAuth app; this serves the gateway process's own
+    # metrics and loop profile (web workers report only their own process)
+    app = web.Application()
+    app.add_routes(diagnostics_routes)
     return app
 
 @routes.get('/')
@@ -23,113 +38,110 @@ async def callback(request):
     state = request.query.get('state') 
     
     if not code or not state:
+        metrics.CALLBACK_REQUESTS.inc(outcome="invalid_request")
         return web.Response(text="Error: Missing code or state.")
 
     try:
-        # State format now: "role_id" (user_id is fetched via token)
-        # Or if we wanted to support multiple args we could but currently just role_id
-        role_id = int(state)
+        # State format: "role_id:guild_id:signature" (user_id is fetched via token);
+        # bare "role_id" states from old panels only during the migration window
+        role_id, guild_id = parse_state(state)
     except ValueError:
-        return web.Response(text="Error: Invalid state format (Role ID missing).")
+        metrics.CALLBACK_REQUESTS.inc(outcome="invalid_request")
+        return web.Response(text="Error: Invalid or outdated verification link. Please ask a server admin to post a new panel.")
 
     # Exchange code for token
-    data = {
-        'client_id': config.CLIENT_ID,
-        'client_secret': config.CLIENT_SECRET,
-        'grant_type': 'authorization_code',
-        'code': code,
-        'redirect_uri': config.REDIRECT_URI
-    }
+    with metrics.CALLBACK_STAGE_SECONDS.time(stage="token_exchange"):
+        resp = await discord_api.exchange_code(code)
+    if resp.status != 200:
+        metrics.CALLBACK_REQUESTS.inc(outcome="token_exchange_failed")
+        return web.Response(text=f"Error fetching token: {resp.data}")
+    token_data = resp.data
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post('https://discord.com/api/oauth2/token', data=data) as resp:
-            if resp.status != 200:
-                return web.Response(text=f"Error fetching token: {await resp.text()}")
-            token_data = await resp.json()
+    # Capture IP
+    ip_address = client_ip(request)
 
-    # Save to DB (We need user_id first!)
-    access_token = token_data['access_token']
-    
-    # Fetch User ID & Profile
-    async with aiohttp.ClientSession() as session:
-        headers = {"Authorization": f"Bearer {access_token}"}
-        async with session.get('https://discord.com/api/users/@me', headers=headers) as user_resp:
-            if user_resp.status != 200:
-                return web.Response(text="Error: Failed to fetch user profile from Discord.")
-            user_data_api = await user_resp.json()
-            user_id = int(user_data_api['id'])
-            username = user_data_api.get('username')
-            avatar = user_data_api.get('avatar')
-            avatar_url = f"https://cdn.discordapp.com/avatars/{user_id}/{avatar}.png" if avatar else None
+    # The code is exchanged, answer the browser now. Profile fetch, storage
+    # write and role grant finish in the background pipeline.
+    job_id = request.app["grant_pipeline"].submit(token_data, role_id, guild_id, ip_address)
+    metrics.CALLBACK_REQUESTS.inc(outcome="accepted")
+    return web.Response(text=PENDING_PAGE.replace("{job_id}", job_id), content_type='text/html')
 
-    # Capture IP
-    # If behind ngrok, the real IP is in X-Forwarded-For
-    forwarded_for = request.headers.get('X-Forwarded-For')
-    if forwarded_for:
-        ip_address = forwarded_for.split(',')[0].strip()
-    else:
-        ip_address = request.remote
+@diagnostics_routes.get('/metrics')
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                        headers={"Cache-Control": "no-cache"})
+
+@diagnostics_routes.get('/debug/profile')
+async def profile(request):
+    # Samples the event loop thread for ?seconds=N (default 10, max 60) and
+    # returns folded stacks, busiest first (flamegraph.pl / speedscope input).
+    # Needs "Authorization: Bearer <DEBUG_TOKEN>"; hidden when no token is set.
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not config.DEBUG_TOKEN or not hmac.compare_digest(token.encode(), config.DEBUG_TOKEN.encode()):
+        raise web.HTTPNotFound()
+    try:
+        seconds = min(max(float(request.query.get("seconds", 10)), 0.1), 60.0)
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds must be a number")
 
-    # Save to JSON Storage
-    user_data_dict = {
-        "user_id": user_id,
-        "username": username,
-        "avatar_url": avatar_url,
-        "ip_address": ip_address,
-        "access_token": access_token,
-        "refresh_token": token_data['refresh_token'],
-        "expires_at": time.time() + token_data['expires_in']
-    }
-    await storage.save_user(user_id, user_data_dict)
+    samples, stacks = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+    lines = [f"# {samples} samples over {seconds:g}s"]
+    lines.extend(f"{stack} {count}" for stack, count in stacks.most_common())
+    return web.Response(text="\n".join(lines) + "\n", content_type='text/plain',
+                        headers={"Cache-Control": "no-cache"})
 
-    # Grant Role
-    bot = request.app["bot"]
-    # We need to find the guild where this role belongs. 
-    # Since we don't have guild_id in state, we have to search common guilds or pass guild_id in state too.
-    # Improved State: "user_id:role_id:guild_id" would be best, but let's try to find the role in shared guilds.
-    
-    # Actually, we can get the guild from the role_id if we iterate, OR just pass guild_id in state.
-    # Let's assume we search all guilds.
-    
-    target_guild = None
-    target_role = None
-    target_member = None
-    
-    for guild in bot.guilds:
-        role = guild.get_role(role_id)
-        if role:
-            target_guild = guild
-            target_role = role
-            target_member = guild.get_member(user_id)
-            break
-    
-    if target_guild and target_role and target_member:
-        try:
-            await target_member.add_roles(target_role)
-            html_content = """
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <title>認証完了</title>
-                <style>
-                    body { font-family: sans-serif; text-align: center; margin-top: 50px; background-color: #2c2f33; color: #ffffff; }
-                    .container { padding: 20px; }
-                    h1 { color: #43b581; }
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h1>認証が完了しました</h1>
-                    <p>このタブを閉じてDiscordに戻ってください。</p>
-                </div>
-            </body>
-            </html>
-            """
-            return web.Response(text=html_content, content_type='text/html')
-        except Exception as e:
-            return web.Response(text=f"Role grant error: {str(e)}")
-    else:
-        return web.Response(text="Error: Could not find the server, member, or role. Please ensure you share a server with the bot.")
-    
-    return web.Response(text="Authentication processing complete.")
+@routes.get('/callback/status/{job_id}')
+async def callback_status(request):
+    status = await request.app["grant_pipeline"].lookup(request.match_info['job_id'])
+    if status is None:
+        return web.json_response({"status": "unknown"}, status=404)
+    return web.json_response(status)
+
+PENDING_PAGE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>認証中</title>
+    <style>
+        body { font-family: sans-serif; text-align: center; margin-top: 50px; background-color: #2c2f33; color: #ffffff; }
+        .container { padding: 20px; }
+        h1 { color: #7289da; }
+        h1.done { color: #43b581; }
+        h1.failed { color: #f04747; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1 id="title">認証を処理しています...</h1>
+        <p id="message">このままお待ちください。</p>
+    </div>
+    <script>
+        const title = document.getElementById("title");
+        const message = document.getElementById("message");
+        // Another web worker may not know the job until it has been forwarded
+        let misses = 0;
+        async function poll() {
+            try {
+                const resp = await fetch("/callback/status/{job_id}");
+                const data = await resp.json();
+                if (data.status === "done") {
+                    title.textContent = "認証が完了しました";
+                    title.className = "done";
+                    message.textContent = "このタブを閉じてDiscordに戻ってください。";
+                    return;
+                }
+                if (data.status === "failed" || (data.status === "unknown" && ++misses > 10)) {
+                    title.textContent = "認証に失敗しました";
+                    title.className = "failed";
+                    message.textContent = data.message || "もう一度お試しください。";
+                    return;
+                }
+            } catch (e) {}
+            setTimeout(poll, 1000);
+        }
+        setTimeout(poll, 500);
+    </script>
+</body>
+</html>
+"""
@@ -1,81 +1,641 @@
-import libsql_client
 import config
-import json
+import logging
 import asyncio
+import secrets
+import time
+from cache import TTLCache
+import metrics
+from storage_backends import create_backend
+from models import USER_FIELDS, UserRecord
 
-# Global client
+log = logging.getLogger(__name__)
+
+# Global client (a backend from storage_backends, selected by STORAGE_BACKEND)
 client = None
+_initialized = False
+_init_lock = asyncio.Lock()
+
+# Read-through caches, kept in sync by the write functions below
+_user_cache = TTLCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+_admin_cache = TTLCache(1, config.ADMIN_CACHE_TTL)  # Holds the whole admin set
+_NOT_FOUND = object()  # Cached marker for users with no stored data
+
+# Optional write-behind buffer for save_user, see start_write_behind()
+_write_buffer = None
+
+# Typed columns of the users table, in storage order (user_id is the key)
+USER_COLUMNS = USER_FIELDS
+
+USERS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        user_id TEXT PRIMARY KEY,
+        username TEXT,
+        avatar_url TEXT,
+        ip_address TEXT,
+        access_token TEXT,
+        refresh_token TEXT,
+        expires_at REAL NOT NULL DEFAULT 0,
+        refresh_failures INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+# SAVE_USER_SQL replaces the whole row, so every save (a successful refresh
+# or a re-verification) also resets refresh_failures to 0.
+
+SAVE_USER_SQL = f"INSERT OR REPLACE INTO users (user_id, {', '.join(USER_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)"
 
 async def init_storage():
-    global client
-    if client is None:
-        client = libsql_client.create_client(
-            url=config.TURSO_URL,
-            auth_token=config.TURSO_TOKEN
-        )
-        
-    # Create tables if not exist
-    await client.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id TEXT PRIMARY KEY,
-            data TEXT
-        )
-    """)
-    await client.execute("""
-        CREATE TABLE IF NOT EXISTS admins (
-            user_id TEXT PRIMARY KEY
-        )
-    """)
+    # Every storage function calls this; the schema work only runs once per process
+    global client, _initialized
+    if _initialized:
+        return
+    async with _init_lock:
+        if _initialized:
+            return
+        if client is None:
+            client = create_backend()
+            
+        # Create tables if not exist
+        await client.execute(USERS_TABLE_SQL.format(name="users"))
+        await client.execute("""
+            CREATE TABLE IF NOT EXISTS admins (
+                user_id TEXT PRIMARY KEY
+            )
+        """)
+        await _migrate_users_table()
+        await _add_refresh_failures_column()
+        await client.execute("CREATE INDEX IF NOT EXISTS idx_users_expires_at ON users (expires_at)")
+        # /list prefix search is case-insensitive, so index the lowercased name
+        await client.execute("DROP INDEX IF EXISTS idx_users_username")
+        await client.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (lower(username), user_id)")
+        await client.execute("CREATE INDEX IF NOT EXISTS idx_users_refresh_failures ON users (refresh_failures) WHERE refresh_failures > 0")
+        await client.execute("""
+            CREATE TABLE IF NOT EXISTS join_jobs (
+                job_id TEXT PRIMARY KEY,
+                guild_id TEXT NOT NULL,
+                channel_id TEXT,
+                requested_by TEXT,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        await client.execute("""
+            CREATE TABLE IF NOT EXISTS join_job_items (
+                job_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                result TEXT,
+                PRIMARY KEY (job_id, user_id)
+            )
+        """)
+        await client.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        # Role grants handed from web workers to the gateway process (RUN_MODE=web/gateway)
+        await client.execute("""
+            CREATE TABLE IF NOT EXISTS role_grant_requests (
+                job_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                role_id TEXT NOT NULL,
+                guild_id TEXT,
+                expires_at REAL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                message TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                not_before REAL NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        await client.execute("CREATE INDEX IF NOT EXISTS idx_role_grant_requests_status ON role_grant_requests (status, not_before)")
+        _initialized = True
+
+async def _migrate_users_table():
+    # Older deployments stored each user as one JSON blob in a `data` column.
+    # Copy those rows into the typed table in a single transaction.
+    rows = await client.execute("PRAGMA table_info(users)")
+    columns = {row[1] for row in rows}
+    if "data" not in columns:
+        return
+
+    log.info("Migrating users table to typed columns...")
+    extracts = ", ".join(f"json_extract(data, '$.{col}')" for col in USER_COLUMNS[:-1])
+    await client.batch([
+        "DROP TABLE IF EXISTS users_new",
+        USERS_TABLE_SQL.format(name="users_new"),
+        f"""INSERT INTO users_new (user_id, {", ".join(USER_COLUMNS)})
+            SELECT user_id, {extracts}, COALESCE(json_extract(data, '$.expires_at'), 0) FROM users""",
+        "DROP TABLE users",
+        "ALTER TABLE users_new RENAME TO users",
+    ])
+    log.info("Users table migration complete.")
+
+async def _add_refresh_failures_column():
+    rows = await client.execute("PRAGMA table_info(users)")
+    if "refresh_failures" not in {row[1] for row in rows}:
+        await client.execute("ALTER TABLE users ADD COLUMN refresh_failures INTEGER NOT NULL DEFAULT 0")
+
+def _user_params(user_id, user):
+    # user is a UserRecord, or a dict in the old layout
+    if not isinstance(user, UserRecord):
+        user = UserRecord.from_dict(user, user_id)
+    return (str(user_id),) + user.to_params()[1:]
+
+class WriteBehindBuffer:
+    # Collects save_user writes and flushes them as batched transactions, either
+    # when max_batch users are pending or every `interval` seconds. Only the last
+    # write per user is kept.
+
+    def __init__(self, max_batch, interval):
+        self.max_batch = max_batch
+        self.interval = interval
+        self.pending = {}  # user_id -> SAVE_USER_SQL params
+        self._inflight = {}  # Batch currently being written
+        self._flush_lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        # Stopped through _stopping rather than cancel(), so a timed flush in
+        # progress always finishes before close() does the final one
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error("Write-behind flush failed, will retry: %s", e)
+
+    def lookup(self, key):
+        params = self.pending.get(key)
+        if params is None:
+            params = self._inflight.get(key)
+        return params
+
+    async def discard(self, key):
+        # Waits out an in-flight flush so the write can't land after a delete
+        async with self._flush_lock:
+            self.pending.pop(key, None)
+
+    async def add(self, key, params):
+        self.pending[key] = params
+        if len(self.pending) >= self.max_batch:
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self.pending:
+                batch, self.pending = self.pending, {}
+                self._inflight = batch
+                items = list(batch.items())
+                try:
+                    for i in range(0, len(items), self.max_batch):
+                        chunk = items[i:i + self.max_batch]
+                        await _batch("save_user_batch", [(SAVE_USER_SQL, params) for _, params in chunk])
+                        for key, _ in chunk:
+                            del batch[key]
+                            # A get_user that read the old row before this landed
+                            # must not cache it once the key leaves the buffer
+                            _user_cache.invalidate(key)
+                finally:
+                    # On any error or cancellation, put back whatever didn't land
+                    # without clobbering newer writes
+                    for key, params in batch.items():
+                        self.pending.setdefault(key, params)
+                    self._inflight = {}
+
+    async def close(self):
+        if self._task:
+            self._stopping.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+async def start_write_behind():
+    global _write_buffer
+    await init_storage()
+    if _write_buffer is None:
+        _write_buffer = WriteBehindBuffer(config.WRITE_BEHIND_BATCH, config.WRITE_BEHIND_INTERVAL)
+        _write_buffer.start()
+
+async def flush_writes():
+    if _write_buffer is not None:
+        await _write_buffer.flush()
+
+async def close_storage():
+    # Flushes every buffered write; call before the process exits
+    global _write_buffer, client, _initialized
+    if _write_buffer is not None:
+        await _write_buffer.close()
+        _write_buffer = None
+    if client is not None:
+        await client.close()
+        client = None
+        _initialized = False
+
+async def _execute(operation, sql, args=()):
+    with metrics.STORAGE_QUERY_SECONDS.time(operation=operation):
+        return await client.execute(sql, args)
+
+async def _batch(operation, statements):
+    with metrics.STORAGE_QUERY_SECONDS.time(operation=operation):
+        await client.batch(statements)
 
 # User Functions
-async def save_user(user_id, data_dict):
+async def save_user(user_id, user):
     await init_storage()
-    # Serialize dict to JSON string for SQLite storage
-    data_json = json.dumps(data_dict)
-    await client.execute(
-        "INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)",
-        (str(user_id), data_json)
-    )
+    params = _user_params(user_id, user)
+    if _write_buffer is not None:
+        await _write_buffer.add(params[0], params)
+    else:
+        await _execute("save_user", SAVE_USER_SQL, params)
+    _user_cache.invalidate(params[0])
 
-async def get_user(user_id):
+async def save_users(users, chunk_size=500):
+    # Bulk upsert of (user_id, UserRecord or dict) pairs, one transaction per chunk
     await init_storage()
-    rs = await client.execute("SELECT data FROM users WHERE user_id = ?", (str(user_id),))
-    if rs.rows:
-        return json.loads(rs.rows[0][0])
-    return None
+    await flush_writes()  # Keep buffered single writes from landing after these
+    chunk = []
+    for user_id, user in users:
+        chunk.append(_user_params(user_id, user))
+        if len(chunk) >= chunk_size:
+            await _batch("save_users", [(SAVE_USER_SQL, params) for params in chunk])
+            chunk = []
+    if chunk:
+        await _batch("save_users", [(SAVE_USER_SQL, params) for params in chunk])
+    _user_cache.clear()
+
+async def get_user(user_id):
+    key = str(user_id)
+    buffered = _write_buffer.lookup(key) if _write_buffer is not None else None
+    if buffered is not None:
+        # Read our own buffered write instead of the stale row
+        return UserRecord.from_row(user_id, buffered[1:])
+    user = _user_cache.get(key)
+    if user is None:
+        await init_storage()
+        generation = _user_cache.generation
+        rows = await _execute("get_user",
+            f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id = ?", (key,)
+        )
+        user = UserRecord.from_row(user_id, rows[0]) if rows else _NOT_FOUND
+        if _write_buffer is None or _write_buffer.lookup(key) is None:
+            _user_cache.set(key, user, generation)
+    if user is _NOT_FOUND:
+        return None
+    # Callers update the returned record in place, never hand out the cached one
+    return user.copy()
 
 async def get_all_users():
-    await init_storage()
-    rs = await client.execute("SELECT user_id, data FROM users")
+    # Loads the whole table; prefer iter_users() for anything that scales with the user count
     users = {}
-    for row in rs.rows:
-        users[row[0]] = json.loads(row[1])
+    async for user_id, user in iter_users():
+        users[user_id] = user
     return users
 
+async def iter_users(chunk_size=500, columns=USER_COLUMNS):
+    # Streams (user_id, UserRecord) in user_id order, one keyset-paginated
+    # SELECT per chunk, so memory stays flat regardless of table size.
+    await init_storage()
+    select = ", ".join(("user_id",) + tuple(columns))
+    last_id = ""
+    while True:
+        rows = await _execute("iter_users",
+            f"SELECT {select} FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (last_id, chunk_size)
+        )
+        for row in rows:
+            yield row[0], UserRecord.from_row(row[0], row[1:], columns)
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+async def count_users(prefix=None):
+    await init_storage()
+    if prefix:
+        rows = await _execute("count_users",
+            "SELECT COUNT(*) FROM users WHERE lower(username) >= ? AND lower(username) < ?", _prefix_range(prefix)
+        )
+    else:
+        rows = await _execute("count_users", "SELECT COUNT(*) FROM users")
+    return rows[0][0]
+
+def _sql_lower(text):
+    # SQLite's lower() only folds ASCII; match it so comparisons line up
+    return "".join(c.lower() if c.isascii() else c for c in text)
+
+def _prefix_range(prefix):
+    # [prefix, next prefix) over lower(username), so idx_users_username_lower
+    # can serve the range
+    prefix = _sql_lower(prefix)
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+async def list_users_page(cursor=None, backwards=False, prefix=None, limit=20):
+    # One keyset-paginated page of (user_id, username), selecting only the
+    # display columns. cursor is the (username, user_id) of the row to page
+    # from: without a prefix pages follow user_id order, with a username
+    # prefix (case-insensitive) they follow (lower(username), user_id) so
+    # idx_users_username_lower is used.
+    await init_storage()
+    where, args = [], []
+    if prefix:
+        where.append("lower(username) >= ? AND lower(username) < ?")
+        args.extend(_prefix_range(prefix))
+        order = ("lower(username)", "user_id")
+        if cursor:
+            op = "<" if backwards else ">"
+            name = _sql_lower(cursor[0] or "")
+            where.append(f"(lower(username) {op} ? OR (lower(username) = ? AND user_id {op} ?))")
+            args.extend((name, name, cursor[1]))
+    else:
+        order = ("user_id",)
+        if cursor:
+            where.append("user_id < ?" if backwards else "user_id > ?")
+            args.append(cursor[1])
+
+    direction = " DESC" if backwards else ""
+    sql = "SELECT user_id, username FROM users"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + ", ".join(col + direction for col in order) + " LIMIT ?"
+    rows = await _execute("list_users_page", sql, (*args, limit))
+    rows = [(row[0], row[1]) for row in rows]
+    if backwards:
+        rows.reverse()
+    return rows
+
 async def remove_user(user_id):
     await init_storage()
-    rs = await client.execute("DELETE FROM users WHERE user_id = ?", (str(user_id),))
-    # rs.rows_affected is not always populated correctly in all libsql versions, 
+    if _write_buffer is not None:
+        # Drop any buffered save so a later flush doesn't bring the user back
+        await _write_buffer.discard(str(user_id))
+    await _execute("remove_user", "DELETE FROM users WHERE user_id = ?", (str(user_id),))
+    _user_cache.invalidate(str(user_id))
+    # rows_affected is not always populated correctly in all libsql versions, 
     # but the DELETE is executed.
     return True
 
+async def record_refresh_failure(user_id):
+    await init_storage()
+    await _execute("record_refresh_failure",
+        "UPDATE users SET refresh_failures = refresh_failures + 1 WHERE user_id = ?", (str(user_id),)
+    )
+
+async def get_user_stats(now=None):
+    # Aggregates for /stats. Each COUNT is answered from an index
+    # (idx_users_expires_at, the partial idx_users_refresh_failures), so no
+    # user rows or tokens are read.
+    await init_storage()
+    now = time.time() if now is None else now
+    total, expired, expiring, failing = await asyncio.gather(
+        _execute("stats_total", "SELECT COUNT(*) FROM users"),
+        _execute("stats_expired", "SELECT COUNT(*) FROM users WHERE expires_at < ?", (now,)),
+        _execute("stats_expiring", "SELECT COUNT(*) FROM users WHERE expires_at >= ? AND expires_at < ?", (now, now + 86400)),
+        _execute("stats_refresh_failures", "SELECT COUNT(*), COALESCE(SUM(refresh_failures), 0) FROM users WHERE refresh_failures > 0"),
+    )
+    return {
+        "total": total[0][0],
+        "expired": expired[0][0],
+        "expiring_24h": expiring[0][0],
+        "refresh_failing_users": failing[0][0],
+        "refresh_failures": failing[0][1],
+    }
+
+def invalidate_user(user_id):
+    # Another process wrote this user; drop our cached copy
+    _user_cache.invalidate(str(user_id))
+
+# Meta Functions (small key/value settings)
+async def get_meta(key):
+    await init_storage()
+    rows = await _execute("get_meta", "SELECT value FROM meta WHERE key = ?", (key,))
+    return rows[0][0] if rows else None
+
+async def set_meta(key, value):
+    await init_storage()
+    await _execute("set_meta", "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
 # Admin Functions
 async def add_admin(user_id):
     await init_storage()
-    await client.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (str(user_id),))
+    await _execute("add_admin", "INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (str(user_id),))
+    _admin_cache.clear()
 
 async def remove_admin(user_id):
     await init_storage()
-    await client.execute("DELETE FROM admins WHERE user_id = ?", (str(user_id),))
+    await _execute("remove_admin", "DELETE FROM admins WHERE user_id = ?", (str(user_id),))
+    _admin_cache.clear()
+
+async def _get_admin_set():
+    admins = _admin_cache.get("admins")
+    if admins is None:
+        await init_storage()
+        generation = _admin_cache.generation
+        rows = await _execute("get_admins", "SELECT user_id FROM admins")
+        admins = frozenset(int(row[0]) for row in rows)
+        _admin_cache.set("admins", admins, generation)
+    return admins
 
 async def get_admins():
-    await init_storage()
-    rs = await client.execute("SELECT user_id FROM admins")
-    return [int(row[0]) for row in rs.rows]
+    return list(await _get_admin_set())
 
 async def is_admin(user_id, root_id):
     if user_id == root_id:
         return True
+    return user_id in await _get_admin_set()
+
+# Join Job Functions
+# A bulk /join is stored as a join_jobs row plus one join_job_items row per
+# user, so an interrupted run can resume with only the users still pending.
+
+async def create_join_job(guild_id, channel_id, requested_by):
+    await init_storage()
+    await flush_writes()  # Buffered users must be in the table for the snapshot
+    job_id = secrets.token_hex(4)
+    now = time.time()
+    # Snapshot every stored user as a pending item in the same transaction
+    await _batch("create_join_job", [
+        ("INSERT INTO join_jobs (job_id, guild_id, channel_id, requested_by, status, created_at, updated_at) VALUES (?, ?, ?, ?, 'running', ?, ?)",
+         (job_id, str(guild_id), str(channel_id) if channel_id else None,
+          str(requested_by) if requested_by else None, now, now)),
+        ("INSERT INTO join_job_items (job_id, user_id) SELECT ?, user_id FROM users", (job_id,)),
+    ])
+    return job_id
+
+def _row_to_join_job(row):
+    return {
+        "job_id": row[0],
+        "guild_id": int(row[1]),
+        "channel_id": int(row[2]) if row[2] else None,
+        "requested_by": int(row[3]) if row[3] else None,
+        "status": row[4],
+        "created_at": row[5],
+        "updated_at": row[6],
+    }
+
+JOIN_JOB_COLUMNS = "job_id, guild_id, channel_id, requested_by, status, created_at, updated_at"
+
+async def get_join_job(job_id):
+    await init_storage()
+    rows = await _execute("get_join_job", f"SELECT {JOIN_JOB_COLUMNS} FROM join_jobs WHERE job_id = ?", (job_id,))
+    if not rows:
+        return None
+    job = _row_to_join_job(rows[0])
+    job["counts"] = await get_join_job_counts(job_id)
+    return job
+
+async def get_join_jobs(status=None, limit=10):
+    await init_storage()
+    if status:
+        rows = await _execute("get_join_jobs",
+            f"SELECT {JOIN_JOB_COLUMNS} FROM join_jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit)
+        )
+    else:
+        rows = await _execute("get_join_jobs",
+            f"SELECT {JOIN_JOB_COLUMNS} FROM join_jobs ORDER BY created_at DESC LIMIT ?", (limit,)
+        )
+    return [_row_to_join_job(row) for row in rows]
+
+async def get_join_job_counts(job_id):
+    await init_storage()
+    rows = await _execute("get_join_job_counts",
+        "SELECT status, COUNT(*) FROM join_job_items WHERE job_id = ? GROUP BY status", (job_id,)
+    )
+    counts = {"pending": 0, "success": 0, "already_in": 0, "failed": 0}
+    for status, count in rows:
+        counts[status] = count
+    return counts
+
+async def set_join_job_status(job_id, status):
+    await init_storage()
+    await _execute("set_join_job_status",
+        "UPDATE join_jobs SET status = ?, updated_at = ? WHERE job_id = ?", (status, time.time(), job_id)
+    )
+
+async def iter_pending_join_items(job_id, chunk_size=500):
+    # Streams (user_id, user_dict) for the job's pending items, keyset-paginated.
+    # Items whose user was removed since the job started are skipped by the JOIN.
+    await init_storage()
+    select = ", ".join(f"u.{col}" for col in USER_COLUMNS)
+    last_id = ""
+    while True:
+        rows = await _execute("iter_pending_join_items",
+            f"""SELECT i.user_id, {select} FROM join_job_items i JOIN users u ON u.user_id = i.user_id
+                WHERE i.job_id = ? AND i.status = 'pending' AND i.user_id > ?
+                ORDER BY i.user_id LIMIT ?""",
+            (job_id, last_id, chunk_size)
+        )
+        for row in rows:
+            yield row[0], UserRecord.from_row(row[0], row[1:])
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+async def save_join_results(job_id, results):
+    # results: list of (user_id, status, result); written as one transaction
+    if not results:
+        return
+    await init_storage()
+    await _batch("save_join_results", [
+        ("UPDATE join_job_items SET status = ?, result = ? WHERE job_id = ? AND user_id = ?",
+         (status, result, job_id, str(user_id)))
+        for user_id, status, result in results
+    ] + [
+        ("UPDATE join_jobs SET updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+    ])
+
+async def finish_join_job(job_id, status):
+    await init_storage()
+    statements = [
+        ("UPDATE join_jobs SET status = ?, updated_at = ? WHERE job_id = ?", (status, time.time(), job_id)),
+    ]
+    if status == "completed":
+        # Items still pending belong to users removed mid-job; close them out
+        statements.append(
+            ("UPDATE join_job_items SET status = 'failed', result = 'user_removed' WHERE job_id = ? AND status = 'pending'", (job_id,))
+        )
+    await _batch("finish_join_job", statements)
+
+# Role-grant requests (web workers -> gateway)
+async def enqueue_role_grant(job_id, user_id, role_id, guild_id, expires_at):
+    await init_storage()
+    await flush_writes()  # The gateway reads the user row when it picks this up
+    now = time.time()
+    await _execute("enqueue_role_grant",
+        "INSERT INTO role_grant_requests (job_id, user_id, role_id, guild_id, expires_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (job_id, str(user_id), str(role_id), str(guild_id) if guild_id else None, expires_at, now, now)
+    )
+
+async def claim_role_grants(limit=50):
+    # Only the gateway process consumes this table, so select-then-mark is safe
+    await init_storage()
+    now = time.time()
+    rows = await _execute("claim_role_grants",
+        "SELECT job_id, user_id, role_id, guild_id, expires_at, attempts FROM role_grant_requests "
+        "WHERE status = 'pending' AND not_before <= ? ORDER BY created_at LIMIT ?",
+        (now, limit)
+    )
+    if not rows:
+        return []
+    await _batch("claim_role_grants", [
+        ("UPDATE role_grant_requests SET status = 'processing', attempts = attempts + 1, updated_at = ? WHERE job_id = ?", (now, row[0]))
+        for row in rows
+    ])
+    return [{
+        "job_id": row[0],
+        "user_id": int(row[1]),
+        "role_id": int(row[2]),
+        "guild_id": int(row[3]) if row[3] else None,
+        "expires_at": row[4],
+        "attempts": row[5] + 1,
+    } for row in rows]
+
+async def finish_role_grant(job_id, status, message=None):
     await init_storage()
-    rs = await client.execute("SELECT 1 FROM admins WHERE user_id = ?", (str(user_id),))
-    return len(rs.rows) > 0
+    await _execute("finish_role_grant",
+        "UPDATE role_grant_requests SET status = ?, message = ?, updated_at = ? WHERE job_id = ?",
+        (status, message, time.time(), job_id)
+    )
+
+async def retry_role_grant(job_id, delay):
+    await init_storage()
+    now = time.time()
+    await _execute("retry_role_grant",
+        "UPDATE role_grant_requests SET status = 'pending', not_before = ?, updated_at = ? WHERE job_id = ?",
+        (now + delay, now, job_id)
+    )
+
+async def requeue_role_grants():
+    # Requests claimed by a gateway that exited before finishing them
+    await init_storage()
+    await _execute("requeue_role_grants",
+        "UPDATE role_grant_requests SET status = 'pending', updated_at = ? WHERE status = 'processing'",
+        (time.time(),)
+    )
+
+async def get_role_grant(job_id):
+    await init_storage()
+    rows = await _execute("get_role_grant",
+        "SELECT status, message FROM role_grant_requests WHERE job_id = ?", (job_id,)
+    )
+    if not rows:
+        return None
+    return {"status": rows[0][0], "message": rows[0][1]}
+
+async def prune_role_grants(older_than):
+    await init_storage()
+    await _execute("prune_role_grants",
+        "DELETE FROM role_grant_requests WHERE status IN ('done', 'failed') AND updated_at < ?",
+        (older_than,)
+    )
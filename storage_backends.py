@@ -0,0 +1,97 @@
+import asyncio
+import sqlite3
+import libsql_client
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+# Both backends expose the same small interface used by storage.py:
+#   await execute(sql, args=()) -> list of rows (indexable by column position)
+#   await batch([sql or (sql, args), ...]) -> runs every statement in one transaction
+#   await close()
+
+class TursoBackend:
+    # Remote libSQL server (Turso Cloud)
+
+    def __init__(self, url, auth_token=None):
+        self._client = libsql_client.create_client(url=url, auth_token=auth_token)
+
+    async def execute(self, sql, args=()):
+        rs = await self._client.execute(sql, args)
+        return rs.rows
+
+    async def batch(self, statements):
+        await self._client.batch(statements)
+
+    async def close(self):
+        await self._client.close()
+
+
+class SQLiteBackend:
+    # Local embedded SQLite file. The connection lives on one dedicated thread so
+    # blocking sqlite3 calls never run on the event loop; WAL mode keeps
+    # readers and the writer from blocking each other on disk.
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",   # Durable across app crashes, fsync only at checkpoints
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-65536",    # 64 MiB page cache
+        "PRAGMA mmap_size=268435456",  # 256 MiB memory-mapped I/O
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            # isolation_level=None: autocommit, transactions only where batch() opens one
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                self._conn.execute(pragma)
+        return self._conn
+
+    def _execute(self, sql, args):
+        return self._connect().execute(sql, args).fetchall()
+
+    def _batch(self, statements):
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            for stmt in statements:
+                if isinstance(stmt, str):
+                    conn.execute(stmt)
+                else:
+                    conn.execute(*stmt)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def execute(self, sql, args=()):
+        return await self._run(self._execute, sql, args)
+
+    async def batch(self, statements):
+        await self._run(self._batch, statements)
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+
+def create_backend():
+    if config.STORAGE_BACKEND == "sqlite":
+        return SQLiteBackend(config.SQLITE_PATH)
+    if config.STORAGE_BACKEND == "turso":
+        return TursoBackend(config.TURSO_URL, config.TURSO_TOKEN)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {config.STORAGE_BACKEND}")
@@ -0,0 +1,109 @@
+"""Standalone OAuth web server for split deployments (RUN_MODE=web).
+
+Serves /callback without a Discord gateway connection, so callback bursts and
+gateway heartbeats no longer share an event loop. Role grants are queued in
+storage and granted by the bot running with RUN_MODE=gateway; both processes
+must use the same storage (Turso, or one SQLite file on the same host).
+
+/metrics and /debug/profile on PORT describe whichever worker the kernel
+handed the connection to, not the whole pool. The gateway process serves its
+own on METRICS_PORT.
+
+Usage:
+    RUN_MODE=gateway python bot.py
+    RUN_MODE=web python web_worker.py --workers 4
+"""
+import argparse
+import logging
+import asyncio
+import multiprocessing
+import os
+import signal
+from aiohttp import web
+import config
+import discord_api
+import server
+import storage
+from grant_pipeline import GrantPipeline
+from loop_monitor import LoopLagMonitor
+from log_setup import setup_logging, stop_logging
+
+log = logging.getLogger(__name__)
+
+
+async def serve(port, reuse_port):
+    monitor = LoopLagMonitor()
+    monitor.start()
+    await storage.init_storage()
+    if config.STORAGE_WRITE_BEHIND:
+        await storage.start_write_behind()
+    pipeline = GrantPipeline()
+    pipeline.start()
+
+    runner = web.AppRunner(server.setup_server(None, pipeline))
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', port, reuse_port=reuse_port)
+    await site.start()
+    log.info("Web worker %d listening on port %d", os.getpid(), port)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    try:
+        await stopping.wait()
+    finally:
+        await runner.cleanup()
+        await monitor.stop()
+        await pipeline.stop()
+        await discord_api.close()
+        await storage.close_storage()  # Flush buffered writes
+
+
+def run_worker(port, reuse_port):
+    setup_logging()
+    try:
+        asyncio.run(serve(port, reuse_port))
+    finally:
+        stop_logging()  # Worker processes exit without running atexit hooks
+
+
+async def prepare_storage():
+    # Create and migrate the schema once, before the workers race to do it
+    await storage.init_storage()
+    await storage.close_storage()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OAuth web worker for RUN_MODE=web")
+    parser.add_argument("--workers", type=int, default=config.WEB_WORKERS, help="processes sharing the port")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8080)))
+    args = parser.parse_args()
+    setup_logging()
+
+    if config.RUN_MODE != "web":
+        log.warning("RUN_MODE is '%s'; make sure the bot runs with RUN_MODE=gateway", config.RUN_MODE)
+
+    asyncio.run(prepare_storage())
+    if args.workers <= 1:
+        run_worker(args.port, False)
+        return
+
+    # SO_REUSEPORT lets the kernel spread connections across the processes
+    procs = [multiprocessing.Process(target=run_worker, args=(args.port, True)) for _ in range(args.workers)]
+    for proc in procs:
+        proc.start()
+
+    def forward(signum, frame):
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+    for proc in procs:
+        proc.join()
+
+
+if __name__ == "__main__":
+    main()